@@ -12,5 +12,7 @@ except Exception, e:
 
 def webapp_add_wsgi_middleware(app):
   from google.appengine.ext.appstats import recording
+  from laddrslib import context
+  app = context.context_middleware(app)
   app = recording.appstats_wsgi_middleware(app)
   return app
@@ -71,14 +71,16 @@ class MainPage(webapp2.RequestHandler):
     elif action == 'get-ladder-data':
       (players, new_players, user_player) = ladder.get_players(user)
       matches = None
+      match_cursor = None
       if ladder.matches_played:
-        matches = ladder.get_matches(user)
+        (matches, match_cursor) = ladder.get_match_page(user)
       template_values = util.add_user_tmplvars(self, {
         'ladder': ladder,
         'user_player': user_player,
         'players': players,
         'new_players': new_players,
         'matches': matches,
+        'match_cursor': match_cursor,
       }, skip_onetime=True)
       path = os.path.join(os.path.dirname(__file__), 'tmpl/players.html')
       player_data = template.render(path, template_values)
@@ -87,6 +89,7 @@ class MainPage(webapp2.RequestHandler):
       json_obj = {
         'players': player_data,
         'match_history': match_data,
+        'match_cursor': match_cursor,
       }
       self.response.out.write(simplejson.dumps(json_obj))
     else:
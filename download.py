@@ -1,6 +1,7 @@
 import re
 import urllib
 
+from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.ext import webapp
@@ -40,7 +41,7 @@ class DownloadReplay(webapp.RequestHandler):
         return
 
     self.response.headers['Content-Type'] = 'application/octet-stream'
-    self.response.out.write(match.replay)
+    self.response.out.write(match.get_replay())
 
 
 class DownloadZip(webapp.RequestHandler):
@@ -65,13 +66,25 @@ class DownloadZip(webapp.RequestHandler):
         self.response.out.write("<h1>Ladder Not Found</h1>")
         return
 
-    zip = ladder.get_matches_zipfile()
     self.response.headers['Content-Type'] = 'application/zip'
-    self.response.out.write(zip)
+    for chunk in ladder.iter_matches_zipfile():
+      self.response.out.write(chunk)
+
+class MigrateReplays(webapp.RequestHandler):
+  """Moves replay files out of match entities into SC2ReplayBlobs, one batch
+     per task. Visit once as an admin to start it."""
+  def get(self):
+    self.post()
+
+  def post(self):
+    cursor = SC2Match.migrate_replays(self.request.get('cursor') or None)
+    if cursor:
+      taskqueue.add(url='/cron/migrate-replays', params={'cursor': cursor})
 
 application = webapp.WSGIApplication([
   ('/download/([^/]+)/([^/]+)/[^/.]+\.SC2Replay', DownloadReplay),
   ('/download/([^/]+).zip', DownloadZip),
+  ('/cron/migrate-replays', MigrateReplays),
 ], debug=True)
 
 
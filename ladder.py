@@ -78,8 +78,14 @@ class MainPage(webapp.RequestHandler):
         return
 
     matches = None
+    match_cursor = None
     if ladder.matches_played and not SLIM:
-      matches = ladder.get_matches(user)
+      try:
+        (matches, match_cursor) = ladder.get_match_page(user,
+            self.request.get('cursor'))
+      except SC2Ladder.InvalidCursor:
+        self.redirect(self.request.path)
+        return
 
     template_values = util.add_user_tmplvars(self, {
       'ladder': ladder,
@@ -87,6 +93,8 @@ class MainPage(webapp.RequestHandler):
       'players': players,
       'new_players': new_players,
       'matches': matches,
+      'match_cursor': match_cursor,
+      'paged_matches': bool(self.request.get('cursor')),
       'manage_ladder': manage_ladder,
       'uploads_accepted': util.get_onetime('uploads_accepted'),
       'uploads_rejected': util.get_onetime('uploads_rejected'),
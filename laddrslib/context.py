@@ -0,0 +1,44 @@
+import os
+import threading
+
+class RequestContext(object):
+  """Values memoized for the length of one request.
+
+  Requests run on several threads at once, so each thread has its own
+  context. context_middleware() starts a fresh one for every request; a
+  context left over from another request is also never handed out.
+  """
+
+  def __init__(self, request_id):
+    self.request_id = request_id
+    self._values = {}
+
+  def get(self, key, default=None):
+    return self._values.get(key, default)
+
+  def set(self, key, value):
+    self._values[key] = value
+
+  def delete(self, key):
+    self._values.pop(key, None)
+
+_local = threading.local()
+
+def current():
+  request_id = os.environ.get('REQUEST_LOG_ID')
+  context = getattr(_local, 'context', None)
+  if context is None or context.request_id != request_id:
+    context = _local.context = RequestContext(request_id)
+  return context
+
+def reset():
+  _local.context = None
+
+def context_middleware(app):
+  def context_app(environ, start_response):
+    reset()
+    try:
+      return app(environ, start_response)
+    finally:
+      reset()
+  return context_app
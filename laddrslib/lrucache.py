@@ -0,0 +1,82 @@
+import collections
+import threading
+import time
+
+class LRUCache(object):
+  """A bounded in-process cache that evicts the least recently used entry.
+  Entries may also expire, after ttl seconds if given, either for the whole
+  cache or per entry.
+
+  Instances are shared between request threads, so every access is locked.
+  """
+
+  def __init__(self, maxsize, ttl=None):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        (expires, value) = self._entries.pop(key)
+      except KeyError:
+        self.misses = self.misses + 1
+        return default
+      if expires is not None and expires <= time.time():
+        self.misses = self.misses + 1
+        return default
+      self._entries[key] = (expires, value)
+      self.hits = self.hits + 1
+      return value
+
+  def get_multi(self, keys):
+    found = {}
+    for key in keys:
+      value = self.get(key, self)
+      if value is not self:
+        found[key] = value
+    return found
+
+  def set(self, key, value, ttl=None):
+    ttl = ttl or self.ttl
+    expires = ttl and time.time() + ttl
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (expires, value)
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+
+  def set_multi(self, mapping, ttl=None):
+    for (key, value) in mapping.iteritems():
+      self.set(key, value, ttl)
+
+  def delete(self, key):
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self):
+    """Hit and miss counts since the cache was created, like
+       memcache.get_stats(), plus the hit rate."""
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'items': len(self._entries),
+        'hit_rate': lookups and float(self.hits) / lookups,
+      }
+
+  def __contains__(self, key):
+    with self._lock:
+      return key in self._entries
+
+  def __len__(self):
+    with self._lock:
+      return len(self._entries)
@@ -1,4 +1,7 @@
+import collections
+import copy
 import datetime
+import hashlib
 import logging
 import math
 import operator
@@ -6,9 +9,7 @@ import os
 import random
 import re
 import string
-import StringIO
 import time
-import zipfile
 
 from django.template.defaultfilters import slugify, force_escape, urlize
 from django.utils import simplejson
@@ -21,24 +22,28 @@ from google.appengine.api import users
 from google.appengine.ext import blobstore
 from google.appengine.ext import db
 
+from laddrslib import context
+from laddrslib import lrucache
 from laddrslib import util
+from laddrslib import zipstream
 
 from third_party import glicko2
 from third_party.sc2ranks import Sc2Ranks
-from third_party.sc2replaylib.replay import Replay
+from third_party.sc2replaylib.batch import parse_replays, ReplayParseError
 
 MC_EXP_SHORT=60
 MC_EXP_MED=1200
 MC_EXP_CHANNEL=7500
 MC_EXP_LONG=86400
 
-MC_PL="public-ladders_v2"
+MC_PL="public-ladders_v3"
 MC_L4U="ladders-for-user_v2"
 MC_M4L="matches-for-ladder_v2"
-MC_P4L="players-for-ladder_v2"
+MC_MP="match-pages_v2"
+MC_P4L="players-for-ladder_v3"
 MC_SC2RP="sc2rank-player_v2"
 MC_LADDER="ladders_v1"
-MC_MATCHES="matches_v2"
+MC_MATCHES="matches_v4"
 MC_USERPLAYER="userplayer_v1"
 MC_FAQS="faqs_v2"
 MC_CID="clientid_v2_%s" % os.getenv('CURRENT_VERSION_ID')
@@ -47,10 +52,22 @@ MC_CHATS="chats_v1"
 MC_PING="chat-pings_v1"
 MC_SJ="silent-joins_v1"
 MC_IDLE="idlers_v1"
+MC_PARSED="parsed-replays_v1"
+MC_GEN="ladder-generations_v1"
+
+# generation of the public ladder list, kept alongside the ladders' own.
+# '|' never appears in a ladder key.
+PUBLIC_LADDERS="|public-ladders"
 
 DISCONNECT_DELAY=60 if util.PRODUCTION else 20
 
 MAX_UNFROZEN_MATCHES=500
+MAX_RATING_CHECKPOINTS=100
+MATCH_PAGE_SIZE=25
+ZIP_BATCH_SIZE=20
+PARSED_REPLAYS_SIZE=512
+LOCAL_CACHE_SIZE=1024
+LOCAL_CACHE_STATS_EVERY=1000
 
 GLICKO_RATING=1500
 GLICKO_RD=350
@@ -67,6 +84,19 @@ sc2ranks_throttle = time.time()
 
 mc = memcache.Client()
 
+# parse results of recent uploads, by sha1 of the replay file.
+parsed_replays = lrucache.LRUCache(PARSED_REPLAYS_SIZE)
+
+# recent memcache reads, by namespace and key. ladder-scoped keys include
+# the ladder's generation, so entries here go unused once it's bumped.
+local_cache = lrucache.LRUCache(LOCAL_CACHE_SIZE, ttl=MC_EXP_MED)
+local_cache_logged = 0
+
+# An uploaded replay file that parsed and passed the checks which don't need
+# the datastore.
+UploadedReplay = collections.namedtuple('UploadedReplay',
+    ['filename', 'data', 'summary'])
+
 class SC2Ladder(db.Model):
   """Ladders ultimately consist of a collection of players and the
      matches/replays between players in the ladder."""
@@ -79,12 +109,16 @@ class SC2Ladder(db.Model):
   invite_code = db.IntegerProperty(required=True)
   matches_played = db.IntegerProperty(required=True)
   minimum_rating_period = db.IntegerProperty(default=0)
+  # rating periods with a valid SC2RatingCheckpoint.
+  rating_checkpoints = db.ListProperty(int, indexed=False)
   players = db.IntegerProperty()
 
   class AlreadyExists(Exception):
     pass
   class DescriptionMissing(Exception):
     pass
+  class InvalidCursor(Exception):
+    pass
   class InvalidName(Exception):
     pass
   class InvalidRegion(Exception):
@@ -115,10 +149,10 @@ class SC2Ladder(db.Model):
       ladder = db.run_in_transaction(_make_transaction, cls.create_ladder,
           user, ladder_name, region, description, public, invite_only,
           player_name, bnet_id, char_code)
-      mc.delete(ladder.get_ladder_key(), namespace=MC_LADDER)
+      bump_ladder_generation(ladder.get_ladder_key())
       mc.delete(user.user_id(), namespace=MC_L4U)
       if public:
-        mc.delete(MC_PL)
+        bump_ladder_generation(PUBLIC_LADDERS)
       return ladder
     else:
       # cleanup
@@ -160,9 +194,9 @@ class SC2Ladder(db.Model):
     if not db.is_in_transaction():
       ladder = db.run_in_transaction(_make_transaction, self.update_ladder,
           description, public, invite_only, regen_invite_code)
-      mc.delete(ladder.get_ladder_key(), namespace=MC_LADDER)
+      bump_ladder_generation(ladder.get_ladder_key())
       mc.delete(users.get_current_user().user_id(), namespace=MC_L4U)
-      mc.delete(MC_PL)
+      bump_ladder_generation(PUBLIC_LADDERS)
       return ladder
     else:
       # sanity checks.
@@ -182,13 +216,10 @@ class SC2Ladder(db.Model):
     if not db.is_in_transaction():
       newplayer = db.run_in_transaction(_make_transaction, self.add_player,
           player_name, bnet_id, char_code, user, admin)
-      lk = self.get_ladder_key()
-      mc.delete(lk, namespace=MC_LADDER)
-      mc.delete("%s|%s" % (lk, user.user_id()), namespace=MC_USERPLAYER)
+      bump_ladder_generation(self.get_ladder_key())
       mc.delete(user.user_id(), namespace=MC_L4U)
-      mc.delete(lk, namespace=MC_P4L)
       if self.public:
-        mc.delete(MC_PL)
+        bump_ladder_generation(PUBLIC_LADDERS)
       ChatChannel.send_chat(self, newplayer, ladder_updated=True,
             sysmsg="has joined the ladder!")
       return newplayer
@@ -237,13 +268,10 @@ class SC2Ladder(db.Model):
     if not db.is_in_transaction():
       if db.run_in_transaction(_make_transaction, self.remove_player,
           player):
-        lk = self.get_ladder_key()
-        mc.delete(lk, namespace=MC_LADDER)
-        mc.delete("%s|%s" % (lk, player.user_id), namespace=MC_USERPLAYER)
+        bump_ladder_generation(self.get_ladder_key())
         mc.delete(player.user_id, namespace=MC_L4U)
-        mc.delete(lk, namespace=MC_P4L)
         if self.public:
-          mc.delete(MC_PL)
+          bump_ladder_generation(PUBLIC_LADDERS)
         ChatChannel.send_chat(self, player, ladder_updated=True,
             sysmsg="quit the ladder.")
         return True
@@ -265,40 +293,64 @@ class SC2Ladder(db.Model):
       # nothing deleted
       return False
 
-  def _reticulate_match_history(self, add_matches=[], remove_match=None):
+  def _reticulate_match_history(self, add_matches=[], remove_match=None,
+      full=False):
     # fetch and reset all player ratings to frozen ratings.
     players = {}
     for player in self.get_players(fast=True):
-      player.glicko_player = glicko2.Player(name=player.name)
-      player.opp_rating_list = []
-      player.opp_rd_list = []
+      # ratings are kept on the Glicko-2 scale until they are saved.
+      player.glicko_player = glicko2.Rating.from_glicko(
+          player.frozen_glicko_rating or GLICKO_RATING,
+          player.frozen_glicko_rd or GLICKO_RD,
+          player.frozen_glicko_vol or GLICKO_VOL)
+      player.opp_mu_list = []
+      player.opp_g_list = []
       player.outcome_list = []
-      if player.frozen_glicko_rating:
-        # float() is required so datastore object is not used.
-        player.glicko_player.setRating(player.frozen_glicko_rating)
-      if player.frozen_glicko_rd:
-        player.glicko_player.setRd(player.frozen_glicko_rd)
-      if player.frozen_glicko_vol:
-        player.glicko_player.vol = player.frozen_glicko_vol
       logging.info("%s loading rating %f/%f/%f", player.name,
           player.glicko_player.rating, player.glicko_player.rd,
           player.glicko_player.vol)
       players[player.key()] = player
 
-    # get all unfrozen matches and replay rating adjustments.
-    matches = SC2Match.gql(
-        "WHERE ANCESTOR IS :1 AND frozen = FALSE", self.key())
-    # GET ALL THE MATCHES!
-    match_history = [m for m in matches] + add_matches
+    # only periods from the earliest one touched by this change need to be
+    # replayed, starting from the checkpoint saved at the start of a period.
+    checkpoint = None
+    if not full:
+      changed = list(add_matches)
+      if remove_match:
+        changed.append(remove_match)
+      checkpoint = self._get_rating_checkpoint(
+          min([m.get_rating_period() for m in changed]), len(add_matches),
+          remove_match)
+
+    if checkpoint:
+      checkpoint.restore(players)
+      logging.info("replaying from checkpoint RP%d", checkpoint.rating_period)
+      # get all matches since the checkpoint and replay rating adjustments.
+      matches = SC2Match.all().ancestor(self).filter('match_date_utc >=',
+          SC2Match.rating_period_start(checkpoint.rating_period))
+      matches.order('-match_date_utc')
+      match_history = [m for m in matches
+          if m.get_rating_period() >= checkpoint.rating_period] + add_matches
+      # all unfrozen matches fit, so nothing will need freezing.
+      matches_to_freeze = 0
+      curr_rating_period = checkpoint.rating_period
+      checkpoints = {curr_rating_period: checkpoint}
+    else:
+      # get all unfrozen matches and replay rating adjustments.
+      matches = SC2Match.gql(
+          "WHERE ANCESTOR IS :1 AND frozen = FALSE", self.key())
+      # GET ALL THE MATCHES!
+      match_history = [m for m in matches] + add_matches
+      # if there are more matches than the allowed number of unfrozen matches,
+      # we'll need to freeze the extras.
+      matches_to_freeze = len(match_history) - MAX_UNFROZEN_MATCHES
+      curr_rating_period = self.minimum_rating_period or 0
+      checkpoints = {}
     # and sort them by date.
     match_history.sort(key=operator.attrgetter('match_date_utc'))
 
-    # if there are more matches than the allowed number of unfrozen matches,
-    # we'll need to freeze the extras.
-    matches_to_freeze = len(match_history) - MAX_UNFROZEN_MATCHES
     # okay now iterate through all the matches to replay rating adjustments.
     frozened_matches = []
-    curr_rating_period = self.minimum_rating_period or 0
     curr_rating_period_matches = []
     for match in match_history:
 
@@ -312,7 +364,8 @@ class SC2Ladder(db.Model):
       new_rating_period = match.get_rating_period()
 
       # set the first current period
-      if not curr_rating_period: curr_rating_period = new_rating_period
+      if not curr_rating_period:
+        curr_rating_period = new_rating_period
 
       # if rating_period has finished, update players.
       if curr_rating_period < new_rating_period:
@@ -358,6 +411,11 @@ class SC2Ladder(db.Model):
       elif curr_rating_period > new_rating_period:
         raise SC2Ladder.PeriodsOutOfOrder
 
+      # checkpoint the start of each period that has matches.
+      if curr_rating_period not in checkpoints:
+        checkpoints[curr_rating_period] = SC2RatingCheckpoint.save(
+            self, curr_rating_period, players)
+
       logging.info("RP%d: replaying match %s (%s)", curr_rating_period,
           match.name, match.get_match_key())
       curr_rating_period_matches.append(match)
@@ -366,116 +424,160 @@ class SC2Ladder(db.Model):
       losing_players = [players[k] for k in match.loser_keys]
 
       # determine what rating and rd to use for opponents.
-      winner_rating = (sum([p.glicko_player.rating for p in winning_players]) /
-          len(losing_players))
-      winner_rd = sum([p.glicko_player.rd for p in winning_players])
-      loser_rating = (sum([p.glicko_player.rating for p in losing_players]) /
-          len(winning_players))
-      loser_rd = sum([p.glicko_player.rd for p in losing_players])
+      (winner_mu, winner_g) = _team_opponent(winning_players, losing_players)
+      (loser_mu, loser_g) = _team_opponent(losing_players, winning_players)
 
       for player in winning_players:
-        player.opp_rating_list.append(loser_rating)
-        player.opp_rd_list.append(loser_rd)
+        player.opp_mu_list.append(loser_mu)
+        player.opp_g_list.append(loser_g)
         player.outcome_list.append(1)
       for player in losing_players:
-        player.opp_rating_list.append(winner_rating)
-        player.opp_rd_list.append(winner_rd)
+        player.opp_mu_list.append(winner_mu)
+        player.opp_g_list.append(winner_g)
         player.outcome_list.append(0)
 
     # calculate pending ratings for the current rating period.
     logging.info("calculating player ratings for RP%d", curr_rating_period)
     self._reticulate_rating_period(players)
 
-    # all done. return player list so they can be saved.
-    return (players, frozened_matches)
-
-  def _reticulate_rating_period(self, players):
+    # save glicko ratings to SC2Player objects, once the replay is done.
     for player in players.itervalues():
-      # if player competed, update player based on period activity
-      old_rating = player.glicko_player.rating
-      old_rd = player.glicko_player.rd
-      old_vol = player.glicko_player.vol
-      if len(player.opp_rating_list):
-        player.glicko_player.update_player(
-            player.opp_rating_list, player.opp_rd_list, player.outcome_list)
-      # but if the player did nothing in this period. adjust RD
-      else:
-        player.glicko_player.did_not_compete()
-      # save glicko ratings to SC2Player object
       player.glicko_rating = player.glicko_player.rating
       player.glicko_rd = player.glicko_player.rd
       player.glicko_vol = player.glicko_player.vol
-      #if (player.glicko_rd != 350 or player.glicko_rating != 1500):
-      logging.debug("%s updated %f/%f/%f -> %f/%f/%f", player.name,
-          old_rating, old_rd, old_vol,
-          player.glicko_rating, player.glicko_rd,
-          player.glicko_vol)
+
+    # checkpoints before the replayed periods are still good; the ones
+    # replayed over are replaced and any left past the end are dropped, as
+    # are all but the latest, since uploads are mostly for recent periods.
+    first_period = checkpoint and checkpoint.rating_period
+    kept = sorted(
+        [rp for rp in self.rating_checkpoints or []
+            if first_period and rp < first_period] +
+        [rp for rp in checkpoints if rp >= self.minimum_rating_period])
+    kept = kept[-MAX_RATING_CHECKPOINTS:]
+    stale_checkpoints = [SC2RatingCheckpoint.get_key(self, rp)
+        for rp in set(self.rating_checkpoints or []) - set(kept)]
+    self.rating_checkpoints = kept
+    checkpoints = [c for (rp, c) in checkpoints.iteritems()
+        if rp in kept and c is not checkpoint]
+
+    # all done. return player list and checkpoints so they can be saved, and
+    # the keys of checkpoints that no longer apply so they can be deleted.
+    return (players, frozened_matches, checkpoints, stale_checkpoints)
+
+  def _get_rating_checkpoint(self, rating_period, new_matches,
+      remove_match=None):
+    """Latest usable checkpoint at or before rating_period, or None when the
+       whole unfrozen history has to be replayed."""
+    if remove_match:
+      # a full replay stops rating at the period of the last match left, so
+      # a removal that empties the last periods has to replay from there.
+      latest = [m for m in SC2Match.all().ancestor(self).order(
+          '-match_date_utc').fetch(2)
+          if m.get_match_key() != remove_match.get_match_key()]
+      if not latest:
+        return None
+      rating_period = min(rating_period, latest[0].get_rating_period())
+    usable = [rp for rp in self.rating_checkpoints or []
+        if self.minimum_rating_period <= rp <= rating_period]
+    if not usable:
+      return None
+    # replaying from a checkpoint can't freeze matches, so only use one when
+    # nothing would need freezing.
+    unfrozen = SC2Match.all(keys_only=True).ancestor(self).filter(
+        'frozen =', False).count(MAX_UNFROZEN_MATCHES + 1)
+    if unfrozen + new_matches > MAX_UNFROZEN_MATCHES:
+      return None
+    return SC2RatingCheckpoint.get_by_key_name(
+        SC2RatingCheckpoint.checkpoint_key(max(usable)), parent=self)
+
+  def verify_ratings(self):
+    """Replays the whole unfrozen match history, ignoring checkpoints, and
+       returns the names of players whose saved rating doesn't match."""
+    stored = dict((p.key(), (p.glicko_rating, p.glicko_rd, p.glicko_vol))
+        for p in self.get_players(fast=True) if p.matches_played)
+    # replay on a copy, since a full replay may freeze matches.
+    ladder = SC2Ladder.get(self.key())
+    (players, _, _, _) = ladder._reticulate_match_history(full=True)
+    mismatched = []
+    for (key, (rating, rd, vol)) in stored.iteritems():
+      player = players[key]
+      if (abs(player.glicko_rating - rating) > 1e-6 or
+          abs(player.glicko_rd - rd) > 1e-6 or
+          abs(player.glicko_vol - vol) > 1e-6):
+        logging.warning("%s saved rating %f/%f/%f, replayed %f/%f/%f",
+            player.name, rating, rd, vol, player.glicko_rating,
+            player.glicko_rd, player.glicko_vol)
+        mismatched.append(player.name)
+    return mismatched
+
+  def _reticulate_rating_period(self, players):
+    # rate everyone at once, as a player's games in the period are known.
+    players = players.values()
+    game_players = []
+    for (i, player) in enumerate(players):
+      game_players.extend([i] * len(player.opp_mu_list))
+    # converting off the Glicko-2 scale isn't free, so only for the log.
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    if debug:
+      old_ratings = [(p.glicko_player.rating, p.glicko_player.rd,
+          p.glicko_player.vol) for p in players]
+    vol_iterations = []
+    glicko2.rate_ratings(
+        [p.glicko_player for p in players],
+        game_players,
+        [mu for p in players for mu in p.opp_mu_list],
+        [g for p in players for g in p.opp_g_list],
+        [o for p in players for o in p.outcome_list],
+        vol_iterations=vol_iterations)
+    if vol_iterations:
+      logging.debug("volatility took up to %d iterations",
+          max(vol_iterations))
+    if debug:
+      for (player, (old_rating, old_rd, old_vol)) in zip(players,
+          old_ratings):
+        logging.debug("%s updated %f/%f/%f -> %f/%f/%f", player.name,
+            old_rating, old_rd, old_vol,
+            player.glicko_player.rating, player.glicko_player.rd,
+            player.glicko_player.vol)
+    for player in players:
       # clear glicko lists.
-      player.opp_rating_list = []
-      player.opp_rd_list = []
+      player.opp_mu_list = []
+      player.opp_g_list = []
       player.outcome_list = []
 
   def _add_new_match(self, user_player, upload, force):
-    replay = None
-    try:
-      replay = Replay(upload.file)
-    except:
-      raise SC2Match.ReplayParseFailed
+    summary = upload.summary
 
+    upload_rating_period = SC2Match.calc_rating_period(summary.timestamp)
     logging.debug("frozen RP%d vs upload RP%d", self.minimum_rating_period,
-        SC2Match.calc_rating_period(replay.timestamp()))
-    if (SC2Match.calc_rating_period(replay.timestamp()) <
-        self.minimum_rating_period):
+        upload_rating_period)
+    if upload_rating_period < self.minimum_rating_period:
       raise SC2Match.ReplayIsTooOld
 
-    # determine the winner and loser players.
-    if replay.teams[0].outcome() == 'Won':
-      replay_winners = replay.teams[0].players
-      replay_losers = replay.teams[1].players
-    elif replay.teams[1].outcome() == 'Won':
-      replay_winners = replay.teams[1].players
-      replay_losers = replay.teams[0].players
-    else:
-      raise SC2Match.ReplayHasNoWinner
-
-    game_type = replay.game_teams()
-    if not GAMETYPE_RE.match(game_type):
-      raise SC2Match.IncorrectType(game_type)
-
     # make sure this replay was not previously uploaded
-    existing_matches = SC2Match.gql(
-        "WHERE ANCESTOR IS :1 AND identifier = :2", self.key(),
-        replay.identifier)
-    if self.get_match(replay.identifier()):
+    if self.has_match(summary.identifier):
       raise SC2Match.MatchAlreadyExists
 
     # now check that all players are in the ladder.
     winners = []
-    winner_races = []
-    winner_colors = []
     user_in_replay = False
-    for rp in replay_winners:
-      player = self.get_player(rp.handle(), rp.bnet_id())
+    for rp in summary.winners:
+      player = self.get_player(rp.handle, rp.bnet_id)
       if not player:
         raise SC2Match.WinnerNotInLadder(
-            "%s/%s" % (rp.handle(), rp.bnet_id()))
+            "%s/%s" % (rp.handle, rp.bnet_id))
       winners.append(player)
-      winner_races.append(rp.race())
-      winner_colors.append(rp.color_name())
       if user_player.user_id == player.user_id:
         user_in_replay = True
 
     losers = []
-    loser_races = []
-    loser_colors = []
-    for rp in replay_losers:
-      player = self.get_player(rp.handle(), rp.bnet_id())
+    for rp in summary.losers:
+      player = self.get_player(rp.handle, rp.bnet_id)
       if not player:
         raise SC2Match.LoserNotInLadder(
-            "%s/%s" % (rp.handle(), rp.bnet_id()))
+            "%s/%s" % (rp.handle, rp.bnet_id))
       losers.append(player)
-      loser_races.append(rp.race())
-      loser_colors.append(rp.color_name())
       if user_player.user_id == player.user_id:
         user_in_replay = True
 
@@ -492,44 +594,68 @@ class SC2Ladder(db.Model):
     if filename:
       filename = filename + '.SC2Replay'
 
-    name = ' '.join([str(replay.timestamp()),
+    name = ' '.join([str(summary.timestamp),
         ', '.join([p.name for p in winners]), 'vs',
         ', '.join([p.name for p in losers]), 'on',
-        replay.map_human_friendly()])
+        summary.map_name])
 
     return SC2Match(
         parent=self,
-        key_name=replay.identifier(),
+        key_name=summary.identifier,
         name=name,
         uploader=user_player,
-        replay=db.Blob(upload.value),
+        replay_blob=SC2ReplayBlob.blob_key(summary.identifier),
         filename=filename,
         winner_keys=[p.key() for p in winners],
-        winner_races=winner_races,
-        winner_colors=winner_colors,
+        winner_races=[rp.race for rp in summary.winners],
+        winner_colors=[rp.color_name for rp in summary.winners],
         loser_keys=[p.key() for p in losers],
-        loser_races=loser_races,
-        loser_colors=loser_colors,
-        mapname=replay.map_human_friendly(),
-        match_date_utc=replay.timestamp(),
-        match_date_local=replay.timestamp_local(),
-        duration=str(datetime.timedelta(seconds=replay.duration())),
-        version='.'.join([str(n) for n in replay.version()]))
+        loser_races=[rp.race for rp in summary.losers],
+        loser_colors=[rp.color_name for rp in summary.losers],
+        mapname=summary.map_name,
+        match_date_utc=summary.timestamp,
+        match_date_local=summary.timestamp_local,
+        duration=str(datetime.timedelta(seconds=summary.duration)),
+        version='.'.join([str(n) for n in summary.version]))
+
+  def _parse_uploads(self, replays):
+    uploads = []
+    rejected = []
+    digests = [hashlib.sha1(upload.value).hexdigest() for upload in replays]
+    results = get_parsed_replays(
+        dict(zip(digests, [upload.value for upload in replays])))
+    for (upload, digest) in zip(replays, digests):
+      result = results[digest]
+      try:
+        summary = SC2Match.check_summary(result)
+        uploads.append(UploadedReplay(upload.filename, upload.value, summary))
+      except SC2Match.UPLOAD_ERRORS, e:
+        rejected.append(SC2Match.rejection_message(upload.filename, e))
+    return (uploads, rejected)
 
   def add_matches(self, user_player, replays, force=False):
     if not db.is_in_transaction():
-      (accepted, rejected, new_matches, players, frozened_matches) = db.run_in_transaction(
-          _make_transaction, self.add_matches, user_player, replays, force)
+      # parse every upload before the transaction, so the ladder isn't held
+      # while replays are decompressed and contention retries don't have to
+      # parse them all over again. the transaction gets UploadedReplays.
+      (uploads, rejected) = self._parse_uploads(replays)
+      if not uploads:
+        return ([], rejected)
+      # replay blobs live in their own entity groups, so they're stored
+      # up front; the transaction only points matches at them. storing is
+      # idempotent, and blobs are shared by content, so one left over by a
+      # rejected upload is reused if the replay is uploaded again.
+      SC2ReplayBlob.store(uploads)
+      (accepted, txn_rejected, new_matches, players, frozened_matches) = db.run_in_transaction(
+          _make_transaction, self.add_matches, user_player, uploads, force)
+      rejected = rejected + txn_rejected
       lk = self.get_ladder_key()
-      mc.delete(lk, namespace=MC_LADDER)
-      mc.delete_multi(
-          [m.get_match_key() for m in frozened_matches], namespace=MC_MATCHES)
+      bump_ladder_generation(lk)
+      cache_delete_multi([m.get_match_key() for m in frozened_matches],
+          key_prefix=match_cache_prefix(lk), namespace=MC_MATCHES)
       mc.delete_multi([p.user_id for p in players], namespace=MC_L4U)
-      mc.delete_multi(["%s|%s" % (lk, p.user_id) for p in players], namespace=MC_USERPLAYER)
-      mc.delete(lk, namespace=MC_P4L)
-      mc.delete(lk, namespace=MC_M4L)
       if self.public:
-        mc.delete(MC_PL)
+        bump_ladder_generation(PUBLIC_LADDERS)
       if new_matches:
         if len(new_matches) == 1:
           ChatChannel.send_chat(self, user_player, ladder_updated=True,
@@ -552,33 +678,8 @@ class SC2Ladder(db.Model):
           new_matches.append(new_match)
           new_matches_idx[new_match.key()] = new_match
           accepted.append(upload.filename)
-        except SC2Match.IncorrectType, e:
-          rejected.append(
-              "%s: %s game type is not supported." % (upload.filename, e.args))
-        except SC2Match.LoserNotInLadder, e:
-          rejected.append(
-              "%s: Loser (%s) is not a member of the ladder." % (upload.filename, e.args))
-        except SC2Match.MatchAlreadyExists:
-          rejected.append(
-              "%s: This match has already been uploaded." % upload.filename)
-        except SC2Match.NotReplayOfUploader:
-          rejected.append(
-              "%s: You may only upload your own replays." % upload.filename)
-        except SC2Match.ReplayIsTooOld:
-          rejected.append(
-              "%s: Uploaded replay is too old. Stop living in the past." % upload.filename)
-        except SC2Match.ReplayHasNoWinner:
-          rejected.append(
-              "%s: Replay has no winner." % upload.filename)
-        except SC2Match.ReplayParseFailed:
-          rejected.append(
-              "%s: Unable to parse uploaded replay file." % upload.filename)
-        except SC2Match.TooManyPlayers, e:
-          rejected.append(
-              "%s: Only 1v1 replays allowed. Uploaded replay has %d players." % (upload.filename, e.args))
-        except SC2Match.WinnerNotInLadder, e:
-          rejected.append(
-              "%s: Winner (%s) is not a member of the ladder." % (upload.filename, e.args))
+        except SC2Match.UPLOAD_ERRORS, e:
+          rejected.append(SC2Match.rejection_message(upload.filename, e))
 
       # check if any replays were actually upload successfully and early out
       # if there were none accepted.
@@ -588,8 +689,8 @@ class SC2Ladder(db.Model):
       # Now we do the meaty work of pulling down match history so we can insert
       # the match into the proper place in time and accurately adjust player
       # ratings.
-      (players, frozened_matches) = self._reticulate_match_history(
-          add_matches=new_matches)
+      (players, frozened_matches, checkpoints, stale_checkpoints) = (
+          self._reticulate_match_history(add_matches=new_matches))
 
       for match in new_matches:
         for key in match.winner_keys:
@@ -620,7 +721,9 @@ class SC2Ladder(db.Model):
 
       # SAVE ALL THE THINGS!
       self.matches_played = self.matches_played + len(new_matches)
-      db.put([self] + frozened_matches + new_matches + players)
+      db.delete(stale_checkpoints)
+      db.put([self] + frozened_matches + new_matches + players + checkpoints +
+          [SC2Leaderboard.build(self, players)])
 
       return (accepted, rejected, new_matches, players, frozened_matches)
 
@@ -629,14 +732,12 @@ class SC2Ladder(db.Model):
       players = db.run_in_transaction(_make_transaction,
           self.remove_match, match, user_player)
       lk = self.get_ladder_key()
-      mc.delete(lk, namespace=MC_LADDER)
-      mc.delete_multi(["%s|%s" % (lk, p.user_id) for p in players], namespace=MC_USERPLAYER)
+      bump_ladder_generation(lk)
+      cache_delete(match_cache_prefix(lk) + match.get_match_key(),
+          namespace=MC_MATCHES)
       mc.delete_multi([p.user_id for p in players], namespace=MC_L4U)
-      mc.delete(match.get_match_key(), namespace=MC_MATCHES)
-      mc.delete(lk, namespace=MC_P4L)
-      mc.delete(lk, namespace=MC_M4L)
       if self.public:
-        mc.delete(MC_PL)
+        bump_ladder_generation(PUBLIC_LADDERS)
       ChatChannel.send_chat(self, user_player, ladder_updated=True,
           sysmsg="removed a match: %s" % force_escape(match.name))
     else:
@@ -654,7 +755,8 @@ class SC2Ladder(db.Model):
             "%s != %s" % match.parent().get_ladder_key(), self.get_ladder_key())
 
       # recreate rating history without this match.
-      (players, _) = self._reticulate_match_history(remove_match=match)
+      (players, _, checkpoints, stale_checkpoints) = (
+          self._reticulate_match_history(remove_match=match))
 
       # update vitals for match participants.
       winners = [players[k] for k in match.winner_keys]
@@ -679,7 +781,9 @@ class SC2Ladder(db.Model):
           player.glicko_rating = 0.0
           player.glicko_rd = 0.0
           player.glicko_vol = 0.0
-      db.put([self] + players)
+      db.delete(stale_checkpoints)
+      db.put([self] + players + checkpoints +
+          [SC2Leaderboard.build(self, players)])
 
       match.delete()
       return players
@@ -689,21 +793,21 @@ class SC2Ladder(db.Model):
       (match_keys, players) = db.run_in_transaction(_make_transaction,
           self.remove_all_the_matches, user_player)
       lk = self.get_ladder_key()
-      mc.delete(lk, namespace=MC_LADDER)
-      mc.delete_multi(
-          [k.name() for k in match_keys], namespace=MC_MATCHES)
-      mc.delete_multi(["%s|%s" % (lk, p.user_id) for p in players], namespace=MC_USERPLAYER)
+      bump_ladder_generation(lk)
+      cache_delete_multi([k.name() for k in match_keys],
+          key_prefix=match_cache_prefix(lk), namespace=MC_MATCHES)
       mc.delete_multi([p.user_id for p in players], namespace=MC_L4U)
-      mc.delete(lk, namespace=MC_P4L)
-      mc.delete(lk, namespace=MC_M4L)
       if self.public:
-        mc.delete(MC_PL)
+        bump_ladder_generation(PUBLIC_LADDERS)
+      SC2ReplayArchive.discard(lk)
       ChatChannel.send_chat(self, user_player, ladder_updated=True,
           sysmsg="removed all the matches!")
     else:
-      # get all the matches, then delete them.s
+      # get all the matches, then delete them.
       match_keys = [k for k in SC2Match.all(keys_only=True).ancestor(self)]
       db.delete_async(match_keys)
+      db.delete_async(
+          [k for k in SC2RatingCheckpoint.all(keys_only=True).ancestor(self)])
       # get all the players and zero their ratings.
       players = [p for p in self.get_players(fast=True)]
       for player in players:
@@ -720,20 +824,22 @@ class SC2Ladder(db.Model):
 
       self.matches_played = 0
       self.minimum_rating_period = 0
+      self.rating_checkpoints = []
 
       # SAVE ALL THE THINGS!
-      db.put([self] + players)
+      db.put([self] + players + [SC2Leaderboard.build(self, players)])
       return (match_keys, players)
 
   @classmethod
   def get_ladder_by_name(cls, ladder_key):
     """Retrieves a SC2Ladder object from the datastore."""
-    ladder = mc.get(ladder_key, namespace=MC_LADDER)
+    lk = cls.ladder_key(ladder_key)
+    mckey = ladder_cache_key(lk, ladder_generation(lk))
+    ladder = cache_get(mckey, namespace=MC_LADDER)
     if ladder:
       return ladder
-    ladder = db.get(db.Key.from_path(
-        'SC2Ladder', cls.ladder_key(ladder_key)))
-    mc.add(ladder_key, ladder, namespace=MC_LADDER, time=MC_EXP_MED)
+    ladder = db.get(db.Key.from_path('SC2Ladder', lk))
+    cache_add(mckey, ladder, namespace=MC_LADDER, time=MC_EXP_MED)
     return ladder
 
   @classmethod
@@ -747,15 +853,23 @@ class SC2Ladder(db.Model):
     if not ladders:
       ladders = []
       logging.info("fetching players for %s", user.nickname())
-      players = SC2Player.gql("WHERE user_id = :1", user.user_id())
-      for player in players:
+      players = [p for p in SC2Player.gql("WHERE user_id = :1", user.user_id())]
+      # one batch get for every ladder's leaderboard, instead of a count
+      # query per ladder.
+      leaderboards = db.get([SC2Leaderboard.leaderboard_key(
+          p.parent_key().name()) for p in players])
+      for (player, leaderboard) in zip(players, leaderboards):
         #logging.info("get ladder for player %s" % player.name)
         ladder = player.get_ladder()
         #logging.info("got ladder %s" % ladder.get_ladder_key())
         ladder.user_player = player
-        ladder.user_player.rank = SC2Player.gql(
-            "WHERE ANCESTOR IS :1 AND glicko_rating > :2",
-            ladder.key(), player.glicko_rating).count() + 1
+        ladder.user_player.rank = leaderboard and leaderboard.rank_of(
+            player.key())
+        if not ladder.user_player.rank and player.matches_played:
+          # ladder hasn't had its leaderboard written yet.
+          ladder.user_player.rank = SC2Player.gql(
+              "WHERE ANCESTOR IS :1 AND glicko_rating > :2",
+              ladder.key(), player.glicko_rating).count() + 1
         ladders.append(ladder)
       # try adding to memcache
       if (not mc.add(
@@ -769,14 +883,53 @@ class SC2Ladder(db.Model):
 
   def get_matches(self, user=None):
     lk = self.get_ladder_key()
-    match_keys = mc.get(lk, namespace=MC_M4L)
+    generation = ladder_generation(lk)
+    mckey = ladder_cache_key(lk, generation)
+    match_keys = cache_get(mckey, namespace=MC_M4L)
     if not match_keys:
       logging.info("fetching match keys for %s", lk)
       query = SC2Match.all(keys_only=True).ancestor(self)
       query.order('-match_date_utc')
       match_keys = [k for k in query]
-      mc.add(lk, match_keys, namespace=MC_M4L, time=MC_EXP_MED)
-    matches = mc.get_multi([k.name() for k in match_keys],
+      cache_add(mckey, match_keys, namespace=MC_M4L, time=MC_EXP_MED)
+    return self._load_matches(match_keys, generation, user)
+
+  def get_match_page(self, user=None, cursor=None, page_size=MATCH_PAGE_SIZE):
+    """A page of matches, newest first, and the cursor of the next page or
+       None on the last page. Each page is cached on its own, keyed by its
+       cursor."""
+    lk = self.get_ladder_key()
+    generation = ladder_generation(lk)
+    cursor = cursor or ''
+    # cursors can be longer than a memcache key allows.
+    mckey = ladder_cache_key(lk, generation, page_size,
+        hashlib.sha1(cursor.encode('utf-8')).hexdigest())
+    page = cache_get(mckey, namespace=MC_MP)
+    if not page:
+      logging.info("fetching match page for %s", lk)
+      query = SC2Match.all(keys_only=True).ancestor(self)
+      query.order('-match_date_utc')
+      try:
+        if cursor:
+          query.with_cursor(cursor)
+        match_keys = query.fetch(page_size)
+      except (db.BadValueError, db.BadRequestError):
+        raise SC2Ladder.InvalidCursor(cursor)
+      next_cursor = None
+      if len(match_keys) == page_size:
+        next_cursor = query.cursor()
+      page = (match_keys, next_cursor)
+      cache_add(mckey, page, namespace=MC_MP, time=MC_EXP_MED)
+    (match_keys, next_cursor) = page
+    return (self._load_matches(match_keys, generation, user), next_cursor)
+
+  def _load_matches(self, match_keys, generation, user=None):
+    lk = self.get_ladder_key()
+    # other instances don't see matches deleted from here, but they do see
+    # the generation bumped along with it, so local copies are kept by it.
+    local_prefix = "%d|" % generation
+    matches = cache_get_multi([k.name() for k in match_keys],
+        key_prefix=match_cache_prefix(lk), local_prefix=local_prefix,
         namespace=MC_MATCHES)
     fetch_keys = []
     for key in match_keys:
@@ -787,31 +940,36 @@ class SC2Ladder(db.Model):
       logging.info("fetching %d matches for %s", len(fetch_keys), lk)
       fetched_matches = SC2Match.get(fetch_keys)
       #logging.info("fetched matches: %s", str(fetched_matches))
+      players = self._get_match_players(fetched_matches)
       recache = {}
       for (key, match) in zip(fetch_keys, fetched_matches):
         #logging.info("fetched %s for %s", str(match), str(key))
-        # this line is literally to force the datastore to fetch the uploading
-        # player object so it can be cached along with everything else.
-        match.uploader = match.uploader
-        # start query for losers asynchronously
-        loser_query = db.get_async(match.loser_keys)
-        # then block on winners so we can iterate through them.
-        match.winners = db.get(match.winner_keys)
-        for (player, race, color) in zip(match.winners,
+        # the uploading player is cached along with everything else.
+        match.uploader = players.get(
+            SC2Match.uploader.get_value_for_datastore(match))
+        # listed matches are read-only; drop any legacy replay bytes so they
+        # aren't cached or rendered around. get_replays() fetches them.
+        match.replay = None
+        # each match gets its own copies of the players, to carry the race
+        # and color they played as.
+        match.winners = []
+        for (player_key, race, color) in zip(match.winner_keys,
             match.winner_races, match.winner_colors):
+          player = copy.copy(players[player_key])
           player.race = race
           player.color = color
-          player.portrait = player.get_portrait(self.region)
-        # block on losers and iterate.
-        match.losers = loser_query.get_result()
-        for (player, race, color) in zip(match.losers,
+          match.winners.append(player)
+        match.losers = []
+        for (player_key, race, color) in zip(match.loser_keys,
             match.loser_races, match.loser_colors):
+          player = copy.copy(players[player_key])
           player.race = race
           player.color = color
-          player.portrait = player.get_portrait(self.region)
+          match.losers.append(player)
         matches[key.name()] = match
         recache[key.name()] = match
-      mc.add_multi(recache, namespace=MC_MATCHES)
+      cache_add_multi(recache, key_prefix=match_cache_prefix(lk),
+          local_prefix=local_prefix, namespace=MC_MATCHES)
 
     ordered_matches = []
     # flag matches owned by the current user.
@@ -826,25 +984,34 @@ class SC2Ladder(db.Model):
       ordered_matches.append(match)
     return ordered_matches
 
-  def get_matches_zipfile(self):
-
-    matches = self.get_matches()
-
-    zipio = StringIO.StringIO()
-
-    zip = zipfile.ZipFile(zipio, mode="w", compression=zipfile.ZIP_DEFLATED)
+  def _get_match_players(self, matches):
+    """Every player in the matches, with their portrait, keyed by player
+       key. Ladder members come from the players cache and anyone else is
+       fetched in a single batch."""
+    players = dict((p.key(), p) for p in self.get_players(fast=True))
+    player_keys = set()
     for match in matches:
-      logging.info("compressing %s.SC2Replay", slugify(match.name))
-      dt = match.match_date_local
-      info = zipfile.ZipInfo(filename=str("%s.SC2Replay" % slugify(match.name)),
-          date_time=(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second))
-      zip.writestr(info, match.replay)
-    zip.close()
-
-    zipdata = zipio.getvalue()
-    zipio.close()
-    return zipdata
-
+      player_keys.update(match.winner_keys)
+      player_keys.update(match.loser_keys)
+      player_keys.add(SC2Match.uploader.get_value_for_datastore(match))
+    player_keys.discard(None)
+    missing = [k for k in player_keys if k not in players]
+    if missing:
+      logging.info("fetching %d players for %s", len(missing),
+          self.get_ladder_key())
+      for (key, player) in zip(missing, db.get(missing)):
+        if player:
+          players[key] = player
+    for key in player_keys:
+      player = players.get(key)
+      if player and not hasattr(player, 'portrait'):
+        player.portrait = player.get_portrait(self.region)
+    return players
+
+  def iter_matches_zipfile(self):
+    """Yields a zip archive of every replay in the ladder, a piece at a
+       time, from the ladder's SC2ReplayArchive."""
+    return SC2ReplayArchive.get_archive(self).iter_data()
 
   def get_player(self, player_name, bnet_id):
     """Retrieves a SC2Player object from the datastore."""
@@ -858,7 +1025,9 @@ class SC2Ladder(db.Model):
         'SC2Ladder', self.get_ladder_key(), 'SC2Player', player_key))
 
   def get_players(self, user=None, fast=False):
-    all_players = mc.get(self.get_ladder_key(), namespace=MC_P4L)
+    mckey = ladder_cache_key(self.get_ladder_key(),
+        ladder_generation(self.get_ladder_key()))
+    all_players = cache_get(mckey, namespace=MC_P4L)
     if not all_players:
       logging.info("fetching players for %s", self.get_ladder_key())
       query = SC2Player.gql(
@@ -869,8 +1038,10 @@ class SC2Ladder(db.Model):
         if portrait:
           player.portrait = portrait
         all_players.append(player)
-      mc.add(
-          self.get_ladder_key(), all_players, namespace=MC_P4L, time=MC_EXP_MED)
+      all_players = SC2Leaderboard.order_players(
+          db.get(SC2Leaderboard.leaderboard_key(self.get_ladder_key())),
+          all_players)
+      cache_add(mckey, all_players, namespace=MC_P4L, time=MC_EXP_MED)
     if fast:
       return all_players
 
@@ -897,20 +1068,22 @@ class SC2Ladder(db.Model):
     return (players, new_players, user_player)
 
   def get_user_player(self, user):
-    mckey = "%s|%s" % (self.get_ladder_key(), user.user_id())
-    player = mc.get(mckey, namespace=MC_USERPLAYER)
+    lk = self.get_ladder_key()
+    mckey = ladder_cache_key(lk, ladder_generation(lk), user.user_id())
+    player = cache_get(mckey, namespace=MC_USERPLAYER)
     if player:
       return player
     player = SC2Player.gql("WHERE ANCESTOR IS :1 AND user_id = :2",
         self.key(), user.user_id()).get()
-    mc.add(mckey, player, namespace=MC_USERPLAYER, time=MC_EXP_MED)
+    cache_add(mckey, player, namespace=MC_USERPLAYER, time=MC_EXP_MED)
     return player
 
   @classmethod
   def get_public_ladders(cls):
     """Queries for all public Ladders."""
     # try memcache first
-    ladders = mc.get(MC_PL)
+    mckey = ladder_cache_key(PUBLIC_LADDERS, ladder_generation(PUBLIC_LADDERS))
+    ladders = cache_get(mckey, namespace=MC_PL)
     # fallback to datastore if necessary
     if not ladders:
       logging.info("fetching public ladders")
@@ -918,9 +1091,15 @@ class SC2Ladder(db.Model):
           "WHERE public = True ORDER BY matches_played DESC, players DESC")
       ladders = q.fetch(100)
       # try adding to memcache, use short expiration as this may change frequently
-      mc.add(MC_PL, ladders, time=MC_EXP_MED)
+      cache_add(mckey, ladders, namespace=MC_PL, time=MC_EXP_MED)
     return ladders
 
+  def has_match(self, id):
+    # keys only, so a legacy match's replay isn't read just to find it.
+    return SC2Match.all(keys_only=True).ancestor(self).filter(
+        '__key__ =', db.Key.from_path(
+            'SC2Ladder', self.get_ladder_key(), 'SC2Match', id)).get() is not None
+
   def get_match(self, id):
     return db.get(db.Key.from_path(
         'SC2Ladder', self.get_ladder_key(),
@@ -977,9 +1156,7 @@ class SC2Player(db.Model):
   def set_admin(self, admin):
     if not db.is_in_transaction():
       rv = db.run_in_transaction(_make_transaction, self.set_admin, admin)
-      lk = self.get_ladder().get_ladder_key()
-      mc.delete("%s|%s" % (lk, self.user_id), namespace=MC_USERPLAYER)
-      mc.delete(lk, namespace=MC_P4L)
+      bump_ladder_generation(self.parent_key().name())
       return rv
     else:
       self.admin = admin
@@ -989,9 +1166,7 @@ class SC2Player(db.Model):
   def set_player_info(self, nickname, email):
     if not db.is_in_transaction():
       rv = db.run_in_transaction(_make_transaction, self.set_player_info, nickname, email)
-      lk = self.get_ladder().get_ladder_key()
-      mc.delete("%s|%s" % (lk, self.user_id), namespace=MC_USERPLAYER)
-      mc.delete(lk, namespace=MC_P4L)
+      bump_ladder_generation(self.parent_key().name())
       return rv
     else:
       self.nickname = nickname
@@ -1046,12 +1221,170 @@ class SC2Player(db.Model):
             self.name, self.bnet_id, exc_info=True)
 
 
+class SC2ReplayBlob(db.Model):
+  """Replay files, keyed by replay identifier. Root entities, so a game
+     uploaded to several ladders is only stored once."""
+  data = db.BlobProperty(required=True)
+
+  @classmethod
+  def blob_key(cls, identifier):
+    return db.Key.from_path('SC2ReplayBlob', identifier)
+
+  @classmethod
+  def store(cls, uploads):
+    """Stores the replay file of every UploadedReplay not already stored."""
+    keys = dict((cls.blob_key(u.summary.identifier), u) for u in uploads)
+    existing = set()
+    pending = keys.keys()
+    # IN filters are limited to 30 values.
+    for i in range(0, len(pending), 30):
+      query = cls.all(keys_only=True).filter('__key__ IN', pending[i:i + 30])
+      existing.update(query)
+    db.put([cls(key=k, data=db.Blob(u.data))
+        for (k, u) in keys.iteritems() if k not in existing])
+
+
+class SC2ReplayArchive(db.Model):
+  """A zip of every replay in a ladder, kept so downloading it is a straight
+     read. Root entity keyed by ladder key. The zipped files are split across
+     SC2ReplayArchiveChunk children, in order; new matches are added by
+     writing more chunks and rewriting the central directory, which is kept
+     here one record per file."""
+  match_keys = db.StringListProperty(indexed=False)
+  directory = db.ListProperty(db.Blob, indexed=False)
+  size = db.IntegerProperty(default=0, indexed=False)
+  chunk_names = db.StringListProperty(indexed=False)
+
+  # entities are limited to 1MB.
+  CHUNK_SIZE = 900 * 1024
+
+  @classmethod
+  def archive_key(cls, ladder_key):
+    return db.Key.from_path(cls.kind(), ladder_key)
+
+  def chunk_keys(self):
+    return [db.Key.from_path(SC2ReplayArchiveChunk.kind(), name,
+        parent=self.key()) for name in self.chunk_names]
+
+  @classmethod
+  def get_archive(cls, ladder):
+    """The ladder's archive, brought up to date with its matches. Matches
+       uploaded since it was written are appended to it; if any were removed
+       it is written again from scratch."""
+    # oldest first, so the archive only ever grows at the end.
+    matches = list(reversed(ladder.get_matches()))
+    key = cls.archive_key(ladder.get_ladder_key())
+    archive = db.get(key)
+    if not archive:
+      return cls(key=key).append(matches)
+    archived = set(archive.match_keys)
+    match_keys = set([m.get_match_key() for m in matches])
+    if archived == match_keys:
+      return archive
+    if archived.issubset(match_keys):
+      return archive.append(
+          [m for m in matches if m.get_match_key() not in archived])
+    return archive.append(matches, rebuild=True)
+
+  @classmethod
+  def discard(cls, ladder_key):
+    key = cls.archive_key(ladder_key)
+    db.delete([key] +
+        [k for k in SC2ReplayArchiveChunk.all(keys_only=True).ancestor(key)])
+
+  def append(self, matches, rebuild=False, batch_size=ZIP_BATCH_SIZE):
+    """Zips up the replays of matches after the ones already archived, or
+       in place of them if rebuild is set, and saves the archive."""
+    if rebuild:
+      stream = zipstream.ZipStream()
+      match_keys = []
+    else:
+      stream = zipstream.ZipStream(offset=self.size,
+          central_directory=self.directory)
+      match_keys = list(self.match_keys)
+    chunk_keys = []
+    pending = []
+    pending_size = 0
+    for i in range(0, len(matches), batch_size):
+      batch = matches[i:i + batch_size]
+      for (match, replay) in zip(batch, SC2Match.get_replays(batch)):
+        match_keys.append(match.get_match_key())
+        if replay is None:
+          logging.warning("no replay for match %s", match.get_match_key())
+          continue
+        dt = match.match_date_local
+        data = stream.add(str("%s.SC2Replay" % slugify(match.name)),
+            (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second),
+            replay)
+        pending.append(data)
+        pending_size = pending_size + len(data)
+        if pending_size >= self.CHUNK_SIZE:
+          data = ''.join(pending)
+          full = len(data) - len(data) % self.CHUNK_SIZE
+          chunk_keys.extend(self._put_chunks(data[:full]))
+          pending = [data[full:]]
+          pending_size = len(pending[0])
+    chunk_keys.extend(self._put_chunks(''.join(pending)))
+    if not rebuild:
+      chunk_keys = self.chunk_keys() + chunk_keys
+    return self._save(match_keys, stream.central_directory, stream.offset,
+        [k.name() for k in chunk_keys])
+
+  def _put_chunks(self, data):
+    chunks = [SC2ReplayArchiveChunk(parent=self.key(),
+        key_name="%016x" % random.getrandbits(64),
+        data=db.Blob(data[i:i + self.CHUNK_SIZE]))
+        for i in range(0, len(data), self.CHUNK_SIZE)]
+    return db.put(chunks)
+
+  def _save(self, match_keys, directory, size, chunk_names):
+    """Switches the archive over to the chunks written by append(), unless
+       another request updated it since this one read it, in which case
+       that one's archive is kept. Chunks left unused either way are
+       deleted."""
+    if not db.is_in_transaction():
+      (archive, unused) = db.run_in_transaction(_make_transaction,
+          self._save, match_keys, directory, size, chunk_names)
+      db.delete_async([db.Key.from_path(SC2ReplayArchiveChunk.kind(), name,
+          parent=self.key()) for name in unused])
+      return archive
+    else:
+      archive = db.get(self.key())
+      if (archive and archive.chunk_names or []) != self.chunk_names:
+        # the ladder's matches may all have been removed meanwhile.
+        return (archive or SC2ReplayArchive(key=self.key()),
+            set(chunk_names) - set(self.chunk_names))
+      unused = set(self.chunk_names) - set(chunk_names)
+      self.match_keys = match_keys
+      self.directory = [db.Blob(r) for r in directory]
+      self.size = size
+      self.chunk_names = chunk_names
+      self.put()
+      return (self, unused)
+
+  def iter_data(self, batch_size=4):
+    """Yields the zip archive, a chunk at a time."""
+    chunk_keys = self.chunk_keys()
+    for i in range(0, len(chunk_keys), batch_size):
+      for chunk in db.get(chunk_keys[i:i + batch_size]):
+        yield chunk.data
+    yield zipstream.ZipStream(offset=self.size,
+        central_directory=self.directory).close()
+
+
+class SC2ReplayArchiveChunk(db.Model):
+  """A piece of an SC2ReplayArchive's zip file. Children of the archive."""
+  data = db.BlobProperty(required=True)
+
+
 class SC2Match(db.Model):
-  """Matches are consist of a replay (stored in BlobStore) plus details
-     parsed from the replay."""
+  """Matches are consist of a replay (stored as an SC2ReplayBlob) plus
+     details parsed from the replay."""
   name = db.StringProperty()
   uploader = db.ReferenceProperty(SC2Player, collection_name='uploads')
-  replay = db.BlobProperty(required=True)
+  replay_blob = db.ReferenceProperty(SC2ReplayBlob, collection_name='matches')
+  # replay file of matches uploaded before SC2ReplayBlob, until migrated.
+  replay = db.BlobProperty()
   filename = db.StringProperty()
   uploaded = db.DateTimeProperty(auto_now_add=True)
   winner_keys = db.ListProperty(db.Key)
@@ -1090,6 +1423,50 @@ class SC2Match(db.Model):
   class WinnerNotInLadder(Exception):
     pass
 
+  # reasons an uploaded replay can be turned down.
+  UPLOAD_ERRORS = (IncorrectType, LoserNotInLadder, MatchAlreadyExists,
+      NotReplayOfUploader, ReplayIsTooOld, ReplayHasNoWinner,
+      ReplayParseFailed, TooManyPlayers, WinnerNotInLadder)
+
+  @classmethod
+  def rejection_message(cls, filename, e):
+    """Tells the uploader why their replay was turned down."""
+    if isinstance(e, cls.IncorrectType):
+      return "%s: %s game type is not supported." % (filename, e.args)
+    elif isinstance(e, cls.LoserNotInLadder):
+      return "%s: Loser (%s) is not a member of the ladder." % (filename, e.args)
+    elif isinstance(e, cls.MatchAlreadyExists):
+      return "%s: This match has already been uploaded." % filename
+    elif isinstance(e, cls.NotReplayOfUploader):
+      return "%s: You may only upload your own replays." % filename
+    elif isinstance(e, cls.ReplayIsTooOld):
+      return "%s: Uploaded replay is too old. Stop living in the past." % filename
+    elif isinstance(e, cls.ReplayHasNoWinner):
+      return "%s: Replay has no winner." % filename
+    elif isinstance(e, cls.ReplayParseFailed):
+      return "%s: Unable to parse uploaded replay file." % filename
+    elif isinstance(e, cls.TooManyPlayers):
+      return "%s: Only 1v1 replays allowed. Uploaded replay has %d players." % (filename, e.args)
+    elif isinstance(e, cls.WinnerNotInLadder):
+      return "%s: Winner (%s) is not a member of the ladder." % (filename, e.args)
+
+  @classmethod
+  def check_summary(cls, summary):
+    """Makes sure a parsed replay is a game the ladder could accept, given
+       what parse_replays returned for it. Ladder membership and duplicates
+       are checked later, inside the ladder transaction."""
+    if isinstance(summary, ReplayParseError):
+      logging.info("replay parse failed: %s", summary)
+      raise cls.ReplayParseFailed
+
+    if not summary.winners:
+      raise cls.ReplayHasNoWinner
+
+    if not GAMETYPE_RE.match(summary.game_teams):
+      raise cls.IncorrectType(summary.game_teams)
+
+    return summary
+
   @classmethod
   def calc_rating_period(cls, dt):
     week = int(dt.strftime("%W"))
@@ -1099,9 +1476,75 @@ class SC2Match(db.Model):
       week == 0
     return year * 100 + week
 
+  @classmethod
+  def rating_period_start(cls, rating_period):
+    """A time no later than the first match of the rating period."""
+    (year, week) = divmod(rating_period, 100)
+    # calc_rating_period puts week 53 in the following year.
+    if week == 53:
+      year = year - 1
+    return (datetime.datetime.strptime("%d %d 1" % (year, week), "%Y %W %w") -
+        datetime.timedelta(days=7))
+
   def get_match_key(self):
     return self.key().id_or_name()
 
+  def get_replay_blob_key(self):
+    return SC2Match.replay_blob.get_value_for_datastore(self)
+
+  def get_replay(self):
+    return self.get_replays([self])[0]
+
+  @classmethod
+  def get_replays(cls, matches):
+    """Replay file of each match, fetched in one batch. Matches not yet
+       migrated to SC2ReplayBlob are fetched again, since listed matches
+       don't carry their replay."""
+    fetch = [m for m in matches if m.get_replay_blob_key() or not m.replay]
+    entities = dict(zip([m.key() for m in fetch],
+        db.get([m.get_replay_blob_key() or m.key() for m in fetch])))
+    replays = []
+    for match in matches:
+      entity = entities.get(match.key(), match)
+      if isinstance(entity, SC2ReplayBlob):
+        replays.append(entity.data)
+      else:
+        replays.append(entity and entity.replay)
+    return replays
+
+  @classmethod
+  def migrate_replays(cls, cursor=None, batch_size=20):
+    """Moves the replay file of a batch of matches into SC2ReplayBlobs.
+       Returns the cursor to continue from, or None once done."""
+    query = cls.all(keys_only=True).order('__key__')
+    if cursor:
+      query.with_cursor(cursor)
+    match_keys = query.fetch(batch_size)
+    for match_key in match_keys:
+      cls._migrate_replay(match_key)
+    if len(match_keys) < batch_size:
+      return None
+    return query.cursor()
+
+  @classmethod
+  def _migrate_replay(cls, match_key):
+    if not db.is_in_transaction():
+      match = db.get(match_key)
+      if not match or match.get_replay_blob_key() or not match.replay:
+        return
+      # replay blobs are root entities, so store it before the transaction.
+      blob_key = SC2ReplayBlob.blob_key(match.get_match_key())
+      if not db.get(blob_key):
+        SC2ReplayBlob(key=blob_key, data=match.replay).put()
+      db.run_in_transaction(_make_transaction, cls._migrate_replay, match_key)
+    else:
+      match = db.get(match_key)
+      if not match or match.get_replay_blob_key():
+        return
+      match.replay_blob = SC2ReplayBlob.blob_key(match.get_match_key())
+      match.replay = None
+      match.put()
+
   def get_rating_period(self):
     return self.calc_rating_period(self.match_date_utc)
 
@@ -1111,6 +1554,108 @@ class SC2Match(db.Model):
         datetime.datetime.utcnow() - datetime.timedelta(days=8))
 
 
+class SC2Leaderboard(db.Model):
+  """A ladder's ranked players in rank order, rewritten in the same
+     transaction as their ratings. Child of the ladder."""
+  player_keys = db.ListProperty(db.Key, indexed=False)
+  ranks = db.ListProperty(int, indexed=False)
+  ratings = db.ListProperty(float, indexed=False)
+  wins = db.ListProperty(int, indexed=False)
+  losses = db.ListProperty(int, indexed=False)
+  last_played = db.ListProperty(datetime.datetime, indexed=False)
+
+  KEY_NAME = "leaderboard"
+
+  @classmethod
+  def leaderboard_key(cls, ladder_key):
+    return db.Key.from_path('SC2Ladder', ladder_key, cls.kind(), cls.KEY_NAME)
+
+  @classmethod
+  def rank_players(cls, players):
+    """Sorts the players who have played by fuzzy rating, the order of the
+       ladder page, and sets their rank. Equal ratings share a rank."""
+    ranked = sorted([p for p in players if p.matches_played],
+        key=operator.attrgetter('fuzzy_rating'), reverse=True)
+    for (i, player) in enumerate(ranked):
+      if i and player.fuzzy_rating == ranked[i - 1].fuzzy_rating:
+        player.rank = ranked[i - 1].rank
+      else:
+        player.rank = i + 1
+    return ranked
+
+  @classmethod
+  def build(cls, ladder, players):
+    ranked = cls.rank_players(players)
+    return cls(parent=ladder, key_name=cls.KEY_NAME,
+        player_keys=[p.key() for p in ranked],
+        ranks=[p.rank for p in ranked],
+        ratings=[p.fuzzy_rating for p in ranked],
+        wins=[p.wins for p in ranked],
+        losses=[p.losses for p in ranked],
+        last_played=[p.last_played or p.joined for p in ranked])
+
+  @classmethod
+  def order_players(cls, leaderboard, players):
+    """The ranked players in leaderboard order with their rank set, followed
+       by the players who haven't played yet."""
+    if leaderboard:
+      by_key = dict((p.key(), p) for p in players)
+      ranked = []
+      for (key, rank) in zip(leaderboard.player_keys, leaderboard.ranks):
+        if key in by_key:
+          by_key[key].rank = rank
+          ranked.append(by_key[key])
+    else:
+      ranked = cls.rank_players(players)
+    ranked_keys = set([p.key() for p in ranked])
+    return ranked + [p for p in players if p.key() not in ranked_keys]
+
+  def rank_of(self, player_key):
+    try:
+      return self.ranks[self.player_keys.index(player_key)]
+    except ValueError:
+      return None
+
+
+class SC2RatingCheckpoint(db.Model):
+  """Every player's Glicko-2 state at the start of a rating period, so the
+     match history can be replayed from there. Children of the ladder."""
+  player_keys = db.ListProperty(db.Key, indexed=False)
+  ratings = db.ListProperty(float, indexed=False)
+  rds = db.ListProperty(float, indexed=False)
+  vols = db.ListProperty(float, indexed=False)
+
+  @classmethod
+  def checkpoint_key(cls, rating_period):
+    return "RP%d" % rating_period
+
+  @classmethod
+  def get_key(cls, ladder, rating_period):
+    return db.Key.from_path(cls.kind(), cls.checkpoint_key(rating_period),
+        parent=ladder.key())
+
+  @property
+  def rating_period(self):
+    return int(self.key().name()[2:])
+
+  @classmethod
+  def save(cls, ladder, rating_period, players):
+    # saved on the Glicko-2 scale, so restoring is exact.
+    ratings = [(key, p.glicko_player) for (key, p) in players.iteritems()]
+    return cls(parent=ladder, key_name=cls.checkpoint_key(rating_period),
+        player_keys=[key for (key, _) in ratings],
+        ratings=[r.mu for (_, r) in ratings],
+        rds=[r.phi for (_, r) in ratings],
+        vols=[r.vol for (_, r) in ratings])
+
+  def restore(self, players):
+    """Players who joined after the checkpoint keep their frozen rating."""
+    for (key, rating, rd, vol) in zip(self.player_keys, self.ratings,
+        self.rds, self.vols):
+      if key in players:
+        players[key].glicko_player = glicko2.Rating(rating, rd, vol)
+
+
 class ChatChannel(db.Model):
   player_name = db.StringProperty()
   connected = db.DateTimeProperty(auto_now=True)
@@ -1464,3 +2009,189 @@ class FaqEntry(db.Model):
 
 def _make_transaction(method, *args):
   return method(*args)
+
+def _team_opponent(team, opponents):
+  """How a team is rated as an opponent: the ratings summed and divided by
+     the size of the other team, with the rating deviations summed. Returns
+     its mu and g(phi) on the Glicko-2 scale."""
+  mu = (sum([p.glicko_player.mu for p in team]) +
+      (len(team) - len(opponents)) * GLICKO_RATING / glicko2.SCALE
+      ) / len(opponents)
+  return (mu, glicko2.g(sum([p.glicko_player.phi for p in team])))
+
+def ladder_generation(ladder_key):
+  """The ladder's cache generation. Every cache key scoped to the ladder
+     includes it, so bumping it invalidates them all at once. Generations
+     start from the clock, so one evicted from memcache doesn't come back
+     as a value older entries were cached under."""
+  generation = context.current().get((MC_GEN, ladder_key))
+  if generation is not None:
+    return generation
+  generation = mc.get(ladder_key, namespace=MC_GEN)
+  if generation is None:
+    generation = int(time.time() * 1000)
+    if not mc.add(ladder_key, generation, namespace=MC_GEN):
+      generation = mc.get(ladder_key, namespace=MC_GEN) or generation
+  context.current().set((MC_GEN, ladder_key), generation)
+  return generation
+
+def bump_ladder_generation(ladder_key):
+  """Invalidates every cache entry scoped to the ladder, in one call."""
+  generation = mc.incr(ladder_key, namespace=MC_GEN,
+      initial_value=int(time.time() * 1000))
+  if generation is None:
+    context.current().delete((MC_GEN, ladder_key))
+  else:
+    context.current().set((MC_GEN, ladder_key), generation)
+  return generation
+
+def ladder_cache_key(ladder_key, generation, *parts):
+  return "|".join([ladder_key, str(generation)] + [str(p) for p in parts])
+
+def match_cache_prefix(ladder_key):
+  """Cached matches are keyed by ladder and match, without the generation:
+     matches only change when they're frozen or removed, and those keys are
+     deleted then. Local copies also carry the generation, see
+     _load_matches()."""
+  return "%s|" % ladder_key
+
+def _copy_cached(value):
+  # requests mark up what they get from the cache (this_is_you, you_won,
+  # user_player), so each gets its own copies of locally cached objects.
+  if isinstance(value, list):
+    return [_copy_cached(v) for v in value]
+  if isinstance(value, db.Model):
+    return copy.copy(value)
+  return value
+
+def _log_cache_stats():
+  global local_cache_logged
+  stats = local_cache.stats()
+  lookups = stats['hits'] + stats['misses']
+  if lookups - local_cache_logged >= LOCAL_CACHE_STATS_EVERY:
+    local_cache_logged = lookups
+    logging.info("local cache: %(hits)d hits, %(misses)d misses, "
+        "%(items)d items, hit rate %(hit_rate).2f", stats)
+
+def _request_memo():
+  # transactions may be retried, so they always get fresh objects to change.
+  if db.is_in_transaction():
+    return {}
+  memo = context.current().get('cache')
+  if memo is None:
+    memo = {}
+    context.current().set('cache', memo)
+  return memo
+
+def cache_get(key, namespace=None, local_ttl=None):
+  """Reads a key from what this request already read, then the instance's
+     local cache, then memcache."""
+  memo = _request_memo()
+  value = memo.get((namespace, key))
+  if value is not None:
+    return value
+  value = local_cache.get((namespace, key))
+  if value is None:
+    value = mc.get(key, namespace=namespace)
+    if value is not None:
+      local_cache.set((namespace, key), value, local_ttl)
+  _log_cache_stats()
+  value = _copy_cached(value)
+  if value is not None:
+    memo[(namespace, key)] = value
+  return value
+
+def cache_get_multi(keys, key_prefix='', namespace=None, local_ttl=None,
+    local_prefix=''):
+  """Like cache_get, for several keys. local_prefix only goes in front of
+     the in-process keys, for entries that memcache keeps for longer than
+     this instance can know they're good for."""
+  memo = _request_memo()
+  results = {}
+  missing = []
+  for key in keys:
+    local_key = (namespace, local_prefix + key_prefix + key)
+    value = memo.get(local_key)
+    if value is None:
+      value = _copy_cached(local_cache.get(local_key))
+    if value is None:
+      missing.append(key)
+    else:
+      results[key] = value
+  if missing:
+    cached = mc.get_multi(missing, key_prefix=key_prefix, namespace=namespace)
+    for (key, value) in cached.iteritems():
+      local_cache.set((namespace, local_prefix + key_prefix + key), value,
+          local_ttl)
+      results[key] = _copy_cached(value)
+  _log_cache_stats()
+  for (key, value) in results.iteritems():
+    memo[(namespace, local_prefix + key_prefix + key)] = value
+  return results
+
+def cache_add(key, value, namespace=None, time=0, local_ttl=None):
+  """Adds a key to memcache and the local cache. The local cache keeps
+     copies, so callers may go on changing what they cached."""
+  if value is not None:
+    _request_memo()[(namespace, key)] = value
+  local_cache.set((namespace, key), _copy_cached(value), local_ttl)
+  return mc.add(key, value, namespace=namespace, time=time)
+
+def cache_add_multi(mapping, key_prefix='', namespace=None, time=0,
+    local_ttl=None, local_prefix=''):
+  memo = _request_memo()
+  for (key, value) in mapping.iteritems():
+    memo[(namespace, local_prefix + key_prefix + key)] = value
+    local_cache.set((namespace, local_prefix + key_prefix + key),
+        _copy_cached(value), local_ttl)
+  return mc.add_multi(mapping, key_prefix=key_prefix, namespace=namespace,
+      time=time)
+
+def cache_delete(key, namespace=None):
+  _request_memo().pop((namespace, key), None)
+  local_cache.delete((namespace, key))
+  return mc.delete(key, namespace=namespace)
+
+def cache_delete_multi(keys, key_prefix='', namespace=None):
+  memo = _request_memo()
+  for key in keys:
+    memo.pop((namespace, key_prefix + key), None)
+    local_cache.delete((namespace, key_prefix + key))
+  return mc.delete_multi(keys, key_prefix=key_prefix, namespace=namespace)
+
+def get_parsed_replays(buffers):
+  """Parses replay files, given as a dict of sha1 -> file contents, and
+     returns a dict of sha1 -> ReplaySummary or ReplayParseError.
+     Results are cached in-process and in memcache by sha1, so a file that
+     was uploaded before is never parsed again, whatever ladder it went to."""
+  results = parsed_replays.get_multi(buffers.keys())
+  missing = [d for d in buffers if d not in results]
+  if missing:
+    cached = mc.get_multi(missing, namespace=MC_PARSED)
+    (summaries, failures) = _split_parsed(cached)
+    parsed_replays.set_multi(summaries)
+    parsed_replays.set_multi(failures, ttl=MC_EXP_SHORT)
+    results.update(cached)
+    missing = [d for d in missing if d not in cached]
+  if missing:
+    parsed = dict(zip(missing, parse_replays([buffers[d] for d in missing])))
+    (summaries, failures) = _split_parsed(parsed)
+    parsed_replays.set_multi(summaries)
+    parsed_replays.set_multi(failures, ttl=MC_EXP_SHORT)
+    mc.set_multi(summaries, time=MC_EXP_LONG, namespace=MC_PARSED)
+    mc.set_multi(failures, time=MC_EXP_SHORT, namespace=MC_PARSED)
+    results.update(parsed)
+  return results
+
+def _split_parsed(parsed):
+  """Splits parse results into summaries and failures. Failures are only
+     cached briefly, as they may be down to a transient error rather than
+     a bad file."""
+  summaries = {}
+  failures = {}
+  for (digest, result) in parsed.iteritems():
+    if isinstance(result, ReplayParseError):
+      failures[digest] = result
+    else:
+      summaries[digest] = result
+  return (summaries, failures)
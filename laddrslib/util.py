@@ -5,9 +5,14 @@ import os
 from google.appengine.api import memcache
 from google.appengine.api import users
 
+from laddrslib import context
+
 MC_EXP_LONG=86400
 MC_ONETIME="onetime-vars"
 MC_CSRF='csrf-tokens'
+# onetime vars a page may show, fetched together on the first read.
+ONETIME_NAMES=['errormsg', 'util_butter', 'util_track_event',
+    'uploads_accepted', 'uploads_rejected']
 SERVER_SOFTWARE = os.getenv('SERVER_SOFTWARE')
 PRODUCTION = not SERVER_SOFTWARE.startswith('Development')
 VERSION = os.getenv('CURRENT_VERSION_ID').replace('-', '.')
@@ -40,16 +45,19 @@ def add_user_tmplvars(handler, tmplvars, skip_onetime=False):
 def get_csrf_token():
   user = users.get_current_user()
   if user:
-    token = memcache.get(user.user_id(), namespace=MC_CSRF)
+    token = context.current().get('csrf_token')
     if token:
       return token
-    token = base64.urlsafe_b64encode(os.urandom(12))
-    memcache.set(user.user_id(), token, namespace=MC_CSRF, time=MC_EXP_LONG)
+    token = memcache.get(user.user_id(), namespace=MC_CSRF)
+    if not token:
+      token = base64.urlsafe_b64encode(os.urandom(12))
+      memcache.set(user.user_id(), token, namespace=MC_CSRF, time=MC_EXP_LONG)
+    context.current().set('csrf_token', token)
     return token
 
 def csrf_protect(handler):
-  if (get_csrf_token() and
-      handler.request.get('csrf_token') == get_csrf_token()):
+  token = get_csrf_token()
+  if token and handler.request.get('csrf_token') == token:
     return True
   return False
 
@@ -57,12 +65,23 @@ def set_onetime(name, msg):
   user = users.get_current_user()
   if user:
     memcache.set("%s|%s" % (user.user_id(), name), msg, namespace=MC_ONETIME)
+    onetimes = context.current().get('onetimes')
+    if onetimes is not None:
+      onetimes[name] = msg
     return True
 
 def get_onetime(name):
   user = users.get_current_user()
   if user:
-    msg = memcache.get("%s|%s" % (user.user_id(), name), namespace=MC_ONETIME)
+    if name in ONETIME_NAMES:
+      onetimes = context.current().get('onetimes')
+      if onetimes is None:
+        onetimes = memcache.get_multi(ONETIME_NAMES,
+            key_prefix="%s|" % user.user_id(), namespace=MC_ONETIME)
+        context.current().set('onetimes', onetimes)
+      msg = onetimes.pop(name, None)
+    else:
+      msg = memcache.get("%s|%s" % (user.user_id(), name), namespace=MC_ONETIME)
     if msg:
       memcache.delete("%s|%s" % (user.user_id(), name), namespace=MC_ONETIME)
       return msg
@@ -0,0 +1,59 @@
+import binascii
+import struct
+import zipfile
+import zlib
+
+class ZipStream(object):
+  """Writes a zip archive one file at a time, returning each piece as it is
+     made so the archive never has to be held in memory. Only the central
+     directory records are kept until close().
+
+     Files are stored uncompressed by default; pass ZIP_DEFLATED to deflate
+     them. To add files to an archive written earlier, pass the offset and
+     central_directory it ended with; only the central directory needs to
+     be written again."""
+
+  def __init__(self, compression=zipfile.ZIP_STORED, offset=0,
+      central_directory=None):
+    if compression not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+      raise RuntimeError("unsupported zip compression %r" % compression)
+    self.compression = compression
+    self.offset = offset
+    self.central_directory = list(central_directory or [])
+
+  def add(self, filename, date_time, data):
+    """Returns the local header and data of a file. date_time is a
+       (year, month, day, hour, minute, second) tuple, as for ZipInfo."""
+    crc = binascii.crc32(data) & 0xffffffff
+    if self.compression == zipfile.ZIP_DEFLATED:
+      compressor = zlib.compressobj(
+          zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+      compressed = compressor.compress(data) + compressor.flush()
+    else:
+      compressed = data
+    (year, month, day, hour, minute, second) = date_time
+    dos_date = (year - 1980) << 9 | month << 5 | day
+    dos_time = hour << 11 | minute << 5 | second // 2
+
+    if (len(self.central_directory) >= 0xffff or
+        self.offset + len(compressed) > 0xffffffff):
+      raise zipfile.LargeZipFile("zip archive would need ZIP64 extensions")
+
+    header = struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader,
+        20, 0, 0, self.compression, dos_time, dos_date, crc,
+        len(compressed), len(data), len(filename), 0)
+    self.central_directory.append(struct.pack(zipfile.structCentralDir,
+        zipfile.stringCentralDir, 20, 0, 20, 0, 0, self.compression,
+        dos_time, dos_date, crc, len(compressed), len(data), len(filename),
+        0, 0, 0, 0, 0600 << 16, self.offset) + filename)
+    chunk = header + filename + compressed
+    self.offset = self.offset + len(chunk)
+    return chunk
+
+  def close(self):
+    """Returns the central directory and end of archive record."""
+    directory = ''.join(self.central_directory)
+    entries = len(self.central_directory)
+    return directory + struct.pack(zipfile.structEndArchive,
+        zipfile.stringEndArchive, 0, 0, entries, entries, len(directory),
+        self.offset, 0)
@@ -194,7 +194,8 @@ laddrs.ChannelMessaged = function(m) {
     var d = document.getElementById("players");
     d.innerHTML = msg.players;
   }
-  if (msg.match_history) {
+  // updates carry the newest page of matches; leave older pages alone.
+  if (msg.match_history && window.location.search.indexOf("cursor=") == -1) {
     var d = document.getElementById("match_history");
     d.innerHTML = msg.match_history;
   }
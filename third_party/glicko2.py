@@ -26,7 +26,22 @@ OTHER DEALINGS IN THE SOFTWARE.
 import logging
 import math
 
-MAX_RD = 350.0 / 173.7178
+# NumPy, once _load_numpy() has imported it. It is only needed for big
+# periods, so it isn't imported up front; that would add tens of
+# milliseconds to every cold start.
+numpy = None
+_numpy_loaded = False
+
+# Ratings and RDs are divided by this to put them on the Glicko-2 scale.
+SCALE = 173.7178
+MAX_RD = 350.0 / SCALE
+
+# Periods with fewer games than this are rated faster in plain Python.
+NUMPY_MIN_GAMES = 64
+# The volatility is solved to within this, as in Glickman's paper.
+VOL_EPSILON = 0.000001
+# The volatility iteration is stopped here if it never settles.
+MAX_VOL_ITERATIONS = 100
 
 class Player:
     # Class attribute
@@ -59,6 +74,7 @@ class Player:
         self.setRd(rd)
         self.vol = vol
         self.name = name
+        self.vol_iterations = 0
 
     def _preRatingRD(self):
         """ Calculates and updates the player's rating deviation for the
@@ -104,30 +120,15 @@ class Player:
 
     def _newVol(self, rating_list, RD_list, outcome_list, v):
         """ Calculating the new volatility as per the Glicko2 system.
+        The number of iterations it took is left in vol_iterations.
 
         _newVol(list, list, list) -> float
 
         """
-        #i = 0
         delta = self._delta(rating_list, RD_list, outcome_list, v)
-        a = math.log(math.pow(self.vol, 2.0))
-        tau = self._tau
-        x0 = a
-        x1 = 0.0
-
-        while x0 != x1:
-            # New iteration, so x(i) becomes x(i-1)
-            x0 = x1
-            d = math.pow(self.__rating, 2.0) + v + math.exp(x0)
-            h1 = (-(x0 - a) / math.pow(tau, 2.0) - 0.5 * math.exp(x0)
-                / d + 0.5 * math.exp(x0) * math.pow(delta / d, 2.0))
-            h2 = (-1.0 / math.pow(tau, 2.0) - 0.5 * math.exp(x0) *
-                (math.pow(self.__rating, 2.0) + v)
-                / math.pow(d, 2.0) + 0.5 * math.pow(delta, 2.0) * math.exp(x0)
-                * (math.pow(self.__rating, 2.0) + v - math.exp(x0)) / math.pow(d, 3.0))
-            x1 = x0 - (h1 / h2)
-
-        return math.exp(x1 / 2.0)
+        (vol, self.vol_iterations) = _solve_vol(self.__rd, v, delta,
+                                                self.vol, self._tau)
+        return vol
 
     def _delta(self, rating_list, RD_list, outcome_list, v):
         """ The delta function of the Glicko2 system.
@@ -179,3 +180,244 @@ class Player:
         self._preRatingRD()
         #logging.info("%s updated to %f/%f/%f", self.name, self.rating, self.rd, self.vol)
 
+
+
+class Rating(object):
+    """ A player's rating, kept on the Glicko-2 scale: mu and phi are the
+    rating and rating deviation divided down by SCALE. Convert with
+    from_glicko and the rating and rd properties when storing. """
+
+    __slots__ = ('mu', 'phi', 'vol')
+
+    def __init__(self, mu=0.0, phi=MAX_RD, vol=0.06):
+        self.mu = mu
+        self.phi = phi
+        self.vol = vol
+
+    @classmethod
+    def from_glicko(cls, rating, rd, vol):
+        return cls((rating - 1500.0) / SCALE, min(rd / SCALE, MAX_RD), vol)
+
+    @property
+    def rating(self):
+        return self.mu * SCALE + 1500.0
+
+    @property
+    def rd(self):
+        return self.phi * SCALE
+
+
+def g(phi):
+    """ The Glicko-2 g(phi) function, worth working out once per opponent
+    per rating period. """
+    return 1.0 / math.sqrt(1.0 + 3.0 * phi * phi / (math.pi * math.pi))
+
+
+def rate_ratings(ratings, game_players, opp_mus, opp_gs, outcomes,
+                 tau=Player._tau, vol_iterations=None):
+    """ Rates a list of Ratings over one rating period, in place.
+
+    Every game a player took part in is one entry of the game sequences:
+    the index of the player in ratings, the opponent's mu and g(phi), and
+    the outcome (1 for a win, 0 for a loss). Players without games are
+    rated as by did_not_compete. The results match Player.update_player
+    to within floating point error.
+
+    NumPy does the work when it is available and the period is big
+    enough to be worth it. If a vol_iterations list is given, it is
+    extended with the volatility iterations each player took.
+
+    rate_ratings(list[Rating], list[int], list, list, list) -> None
+    """
+    if len(game_players) >= NUMPY_MIN_GAMES and _load_numpy() is not None:
+        rate = _rate_period_numpy
+    else:
+        rate = _rate_period_python
+    (mus, phis, vols, iterations) = rate(
+        [r.mu for r in ratings], [r.phi for r in ratings],
+        [r.vol for r in ratings], game_players, opp_mus, opp_gs, outcomes,
+        tau)
+    for (rating, mu, phi, vol) in zip(ratings, mus, phis, vols):
+        rating.mu = mu
+        rating.phi = phi
+        rating.vol = vol
+    if vol_iterations is not None:
+        vol_iterations.extend(iterations)
+
+
+def rate_period(ratings, rds, vols, game_players, opp_ratings, opp_rds,
+                outcomes, tau=Player._tau, vol_iterations=None):
+    """ rate_ratings for ratings and RDs on the Glicko scale, given as
+    parallel sequences.
+
+    rate_period(list, list, list, list[int], list, list, list)
+        -> (list, list, list)
+    """
+    players = [Rating.from_glicko(rating, rd, vol)
+               for (rating, rd, vol) in zip(ratings, rds, vols)]
+    rate_ratings(players, game_players,
+                 [(r - 1500.0) / SCALE for r in opp_ratings],
+                 [g(rd / SCALE) for rd in opp_rds], outcomes, tau,
+                 vol_iterations)
+    return ([p.rating for p in players], [p.rd for p in players],
+            [p.vol for p in players])
+
+
+def _rate_period_python(mus, phis, vols, game_players, opp_mus, opp_gs,
+                        outcomes, tau):
+    v_sum = [0.0] * len(mus)
+    score_sum = [0.0] * len(mus)
+    played = [False] * len(mus)
+    for i, opp_mu, g, outcome in zip(game_players, opp_mus, opp_gs,
+                                     outcomes):
+        e = 1.0 / (1.0 + math.exp(-g * (mus[i] - opp_mu)))
+        v_sum[i] += g * g * e * (1.0 - e)
+        score_sum[i] += g * (outcome - e)
+        played[i] = True
+
+    new_mus = []
+    new_phis = []
+    new_vols = []
+    iterations = [0] * len(mus)
+    for i in range(len(mus)):
+        (mu, phi, vol) = (mus[i], phis[i], vols[i])
+        if played[i]:
+            v = 1.0 / v_sum[i]
+            (vol, iterations[i]) = _solve_vol(phi, v, v * score_sum[i],
+                                              vol, tau)
+            phi_star = min(math.sqrt(phi * phi + vol * vol), MAX_RD)
+            phi = min(1.0 / math.sqrt(1.0 / (phi_star * phi_star) + 1.0 / v),
+                      MAX_RD)
+            mu = mu + phi * phi * score_sum[i]
+        else:
+            phi = min(math.sqrt(phi * phi + vol * vol), MAX_RD)
+        new_mus.append(mu)
+        new_phis.append(phi)
+        new_vols.append(vol)
+    return (new_mus, new_phis, new_vols, iterations)
+
+
+def _solve_vol(phi, v, delta, vol, tau):
+    """ Step 5 of Glickman's Glicko-2 paper: the new volatility, found with
+    the Illinois algorithm. Returns it with the number of iterations taken.
+    """
+    a = math.log(vol * vol)
+    tau2 = tau * tau
+    phi2_v = phi * phi + v
+    delta2 = delta * delta
+
+    def f(x):
+        ex = math.exp(x)
+        d = phi2_v + ex
+        return ex * (delta2 - phi2_v - ex) / (2.0 * d * d) - (x - a) / tau2
+
+    A = a
+    if delta2 > phi2_v:
+        B = math.log(delta2 - phi2_v)
+    else:
+        k = 1
+        while f(a - k * tau) < 0 and k < MAX_VOL_ITERATIONS:
+            k += 1
+        B = a - k * tau
+    fA = f(A)
+    fB = f(B)
+    iterations = 0
+    while (abs(B - A) > VOL_EPSILON and fA != fB and
+           iterations < MAX_VOL_ITERATIONS):
+        C = A + (A - B) * fA / (fB - fA)
+        fC = f(C)
+        if fC * fB <= 0:
+            A = B
+            fA = fB
+        else:
+            fA = fA / 2.0
+        B = C
+        fB = fC
+        iterations += 1
+    return (math.exp(A / 2.0), iterations)
+
+
+def _load_numpy():
+    """Imports NumPy the first time it is needed. Returns None if it isn't
+    available."""
+    global numpy, _numpy_loaded
+    if not _numpy_loaded:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_loaded = True
+    return numpy
+
+def _rate_period_numpy(mus, phis, vols, game_players, opp_mus, opp_gs,
+                       outcomes, tau):
+    mu = numpy.asarray(mus, dtype=float)
+    phi = numpy.asarray(phis, dtype=float)
+    vol = numpy.array(vols, dtype=float)
+    players = numpy.asarray(game_players, dtype=int)
+    g = numpy.asarray(opp_gs, dtype=float)
+
+    e = 1.0 / (1.0 + numpy.exp(-g * (mu[players] -
+                                     numpy.asarray(opp_mus, dtype=float))))
+    n = len(mu)
+    v_sum = numpy.bincount(players, g * g * e * (1.0 - e), n)
+    score_sum = numpy.bincount(
+        players, g * (numpy.asarray(outcomes, dtype=float) - e), n)
+
+    # everyone starts out as if they did not compete.
+    new_mu = mu.copy()
+    new_phi = numpy.minimum(numpy.sqrt(phi * phi + vol * vol), MAX_RD)
+    played = numpy.bincount(players, minlength=n).nonzero()[0]
+    iterations = numpy.zeros(n, dtype=int)
+    if len(played):
+        v = 1.0 / v_sum[played]
+        (vol[played], iterations[played]) = _solve_vol_numpy(
+            phi[played], v, v * score_sum[played], vol[played], tau)
+        phi_star = numpy.minimum(
+            numpy.sqrt(phi[played] ** 2 + vol[played] ** 2), MAX_RD)
+        new_phi[played] = numpy.minimum(
+            1.0 / numpy.sqrt(1.0 / phi_star ** 2 + 1.0 / v), MAX_RD)
+        new_mu[played] += new_phi[played] ** 2 * score_sum[played]
+    return (new_mu.tolist(), new_phi.tolist(), vol.tolist(),
+            iterations.tolist())
+
+
+def _solve_vol_numpy(phi, v, delta, vol, tau):
+    # _solve_vol for every player at once; players that have settled keep
+    # their value while the rest carry on.
+    a = numpy.log(vol * vol)
+    tau2 = tau * tau
+    phi2_v = phi * phi + v
+    delta2 = delta * delta
+
+    def f(x):
+        ex = numpy.exp(x)
+        d = phi2_v + ex
+        return ex * (delta2 - phi2_v - ex) / (2.0 * d * d) - (x - a) / tau2
+
+    A = a
+    above = delta2 > phi2_v
+    B = numpy.where(above, numpy.log(numpy.where(above, delta2 - phi2_v, 1.0)),
+                    a - tau)
+    low = ~above & (f(B) < 0)
+    k = 1
+    while low.any() and k < MAX_VOL_ITERATIONS:
+        k += 1
+        B = numpy.where(low, a - k * tau, B)
+        low &= f(B) < 0
+    fA = f(A)
+    fB = f(B)
+    iterations = numpy.zeros(len(a), dtype=int)
+    for i in range(MAX_VOL_ITERATIONS):
+        active = (numpy.abs(B - A) > VOL_EPSILON) & (fA != fB)
+        if not active.any():
+            break
+        C = A + (A - B) * fA / numpy.where(active, fB - fA, 1.0)
+        fC = f(C)
+        swap = active & (fC * fB <= 0)
+        A = numpy.where(swap, B, A)
+        fA = numpy.where(swap, fB, numpy.where(active, fA / 2.0, fA))
+        B = numpy.where(active, C, B)
+        fB = numpy.where(active, fC, fB)
+        iterations += active
+    return (numpy.exp(A / 2.0), iterations)
@@ -5,13 +5,15 @@
 mpyq is a Python library for reading MPQ (MoPaQ) archives.
 """
 
-from third_party import argparse
+import array
 import bz2
 import cStringIO
 import os
 import struct
+import sys
 import zlib
 from third_party.collections26 import namedtuple
+from third_party.mpyq_table import ENCRYPTION_TABLE
 
 
 __author__ = "Aku Kotkavuo"
@@ -82,6 +84,67 @@ MPQBlockTableEntry = namedtuple('MPQBlockTableEntry',
 )
 MPQBlockTableEntry.struct_format = '4I'
 
+# Typecode for unsigned 32-bit words, used to decrypt tables in bulk.
+_UINT32 = 'I' if array.array('I').itemsize == 4 else 'L'
+
+# Hashes of file and table names, shared between archives. Replays always
+# look up the same handful of names so this stays small; the cap only guards
+# against archives listing lots of unusual files.
+_hash_cache = {}
+_HASH_CACHE_SIZE = 256
+
+
+class MPQLazyFiles(object):
+    """Read-only mapping of the files inside a MPQ archive.
+
+    Files are only read and decompressed the first time they are looked
+    up, so callers that need a couple of files out of a large archive
+    don't pay for extracting everything else.
+    """
+
+    def __init__(self, archive):
+        self.archive = archive
+        self._files = {}
+
+    def __getitem__(self, filename):
+        if filename not in self._files:
+            data = self.archive.read_file(filename)
+            if data is None:
+                raise KeyError(filename)
+            self._files[filename] = data
+        return self._files[filename]
+
+    def __contains__(self, filename):
+        return (filename in self._files or
+                self.archive.get_hash_table_entry(filename) is not None)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, filename, default=None):
+        try:
+            return self[filename]
+        except KeyError:
+            return default
+
+    def read_prefix(self, filename, max_bytes):
+        """Return the first max_bytes of a file, reading as little as
+        possible unless the whole file has already been read."""
+        if filename in self._files:
+            return self._files[filename][:max_bytes]
+        data = self.archive.read_file(filename, max_bytes=max_bytes)
+        if data is None:
+            raise KeyError(filename)
+        return data
+
+    def keys(self):
+        if self.archive.files is None:
+            raise RuntimeError("Can't list archive files without listfile.")
+        return list(self.archive.files)
+
 
 class MPQArchive(object):
 
@@ -98,6 +161,7 @@ class MPQArchive(object):
             self.file = open(filename, 'rb')
         self.header = self.read_header()
         self.hash_table = self.read_table('hash')
+        self.hash_index = self._index_hash_table(self.hash_table)
         self.block_table = self.read_table('block')
         if listfile:
             self.files = self.read_file('(listfile)').splitlines()
@@ -161,23 +225,37 @@ class MPQArchive(object):
         data = self.file.read(table_entries * 16)
         data = self._decrypt(data, key)
 
-        def unpack_entry(position):
-            entry_data = data[position*16:position*16+16]
-            return entry_class._make(
-                struct.unpack(entry_class.struct_format, entry_data))
+        # Unpack the whole table in one go, then split it into entries.
+        values = struct.unpack(entry_class.struct_format * table_entries,
+                               data[:table_entries*16])
+        fields = len(entry_class._fields)
+        return [entry_class._make(values[i:i+fields])
+                for i in range(0, len(values), fields)]
 
-        return [unpack_entry(i) for i in range(table_entries)]
+    def _index_hash_table(self, hash_table):
+        """Index hash table entries by their (hash_a, hash_b) pair.
+
+        The first entry wins if a pair occurs more than once, same as a
+        linear scan of the table would.
+        """
+        index = {}
+        for entry in hash_table:
+            index.setdefault((entry.hash_a, entry.hash_b), entry)
+        return index
 
     def get_hash_table_entry(self, filename):
         """Get the hash table entry corresponding to a given filename."""
         hash_a = self._hash(filename, 'HASH_A')
         hash_b = self._hash(filename, 'HASH_B')
-        for entry in self.hash_table:
-            if (entry.hash_a == hash_a and entry.hash_b == hash_b):
-                return entry
+        return self.hash_index.get((hash_a, hash_b))
 
-    def read_file(self, filename):
-        """Read a file from the MPQ archive."""
+    def read_file(self, filename, max_bytes=None):
+        """Read a file from the MPQ archive.
+
+        If max_bytes is given, at most that many bytes from the start of
+        the file are returned and only the sectors covering them are read
+        and decompressed.
+        """
 
         def decompress(data):
             """Read the compression type and decompress file data."""
@@ -185,6 +263,10 @@ class MPQArchive(object):
             if compression_type == 0:
                 return data
             elif compression_type == 2:
+                if max_bytes is not None:
+                    # zlib can stop early once enough output is produced.
+                    return zlib.decompressobj(15).decompress(data[1:],
+                                                             max_bytes or 1)
                 return zlib.decompress(data[1:], 15)
             elif compression_type == 16:
                 return bz2.decompress(data[1:])
@@ -200,7 +282,6 @@ class MPQArchive(object):
         if block_entry.flags & MPQ_FILE_EXISTS:
             offset = block_entry.offset + self.header['offset']
             self.file.seek(offset)
-            file_data = self.file.read(block_entry.archived_size)
 
             if block_entry.flags & MPQ_FILE_ENCRYPTED:
                 raise NotImplementedError("Encryption is not supported yet.")
@@ -216,26 +297,45 @@ class MPQArchive(object):
                 else:
                     crc = False
                 positions = struct.unpack('<%dI' % (sectors + 1),
-                                          file_data[:4*(sectors+1)])
+                                          self.file.read(4*(sectors+1)))
+                needed = len(positions) - (2 if crc else 1)
+                if max_bytes is not None:
+                    needed = min(needed,
+                                 (max_bytes + sector_size - 1) / sector_size)
+                # Only read as far as the last sector we need.
+                self.file.seek(offset + positions[0])
+                file_data = self.file.read(positions[needed] - positions[0])
                 result = cStringIO.StringIO()
-                for i in range(len(positions) - (2 if crc else 1)):
-                    sector = file_data[positions[i]:positions[i+1]]
+                for i in range(needed):
+                    sector = file_data[positions[i] - positions[0]:
+                                       positions[i+1] - positions[0]]
                     if (block_entry.flags & MPQ_FILE_COMPRESS and
                         block_entry.size > block_entry.archived_size):
                         sector = decompress(sector)
                     result.write(sector)
                 file_data = result.getvalue()
             else:
+                file_data = self.file.read(block_entry.archived_size)
                 # Single unit files only need to be decompressed, but
                 # compression only happens when at least one byte is gained.
                 if (block_entry.flags & MPQ_FILE_COMPRESS and
                     block_entry.size > block_entry.archived_size):
                     file_data = decompress(file_data)
 
+            if max_bytes is not None:
+                file_data = file_data[:max_bytes]
             return file_data
 
-    def extract(self):
-        """Extract all the files inside the MPQ archive in memory."""
+    def extract(self, lazy=False):
+        """Extract all the files inside the MPQ archive in memory.
+
+        With lazy=True a mapping is returned instead which only reads
+        and decompresses a file when it is first accessed. The lazy
+        mapping also works without a listfile for files looked up by
+        name.
+        """
+        if lazy:
+            return MPQLazyFiles(self)
         if self.files:
             return dict((f, self.read_file(f)) for f in self.files)
         else:
@@ -305,6 +405,11 @@ class MPQArchive(object):
 
     def _hash(self, string, hash_type):
         """Hash a string using MPQ's hash function."""
+        try:
+            return _hash_cache[(string, hash_type)]
+        except KeyError:
+            pass
+
         hash_types = {
             'TABLE_OFFSET': 0,
             'HASH_A': 1,
@@ -320,52 +425,69 @@ class MPQArchive(object):
             seed1 = (value ^ (seed1 + seed2)) & 0xFFFFFFFF
             seed2 = ch + seed1 + seed2 + (seed2 << 5) + 3 & 0xFFFFFFFF
 
+        if len(_hash_cache) < _HASH_CACHE_SIZE:
+            _hash_cache[(string, hash_type)] = seed1
         return seed1
 
     def _decrypt(self, data, key):
         """Decrypt hash or block table or a sector."""
         seed1 = key
         seed2 = 0xEEEEEEEE
-        result = cStringIO.StringIO()
+        decryption_table = self.encryption_table[0x400:0x500]
+
+        # Unpack every whole word at once rather than one slice at a time.
+        words = array.array(_UINT32, data[:len(data) & ~3])
+        if sys.byteorder == 'big':
+            words.byteswap()
 
-        for i in range(len(data) // 4):
-            seed2 += self.encryption_table[0x400 + (seed1 & 0xFF)]
-            seed2 &= 0xFFFFFFFF
-            value = struct.unpack("<I", data[i*4:i*4+4])[0]
-            value = (value ^ (seed1 + seed2)) & 0xFFFFFFFF
+        result = []
+        append = result.append
+        for word in words:
+            seed2 = (seed2 + decryption_table[seed1 & 0xFF]) & 0xFFFFFFFF
+            value = (word ^ (seed1 + seed2)) & 0xFFFFFFFF
 
-            seed1 = ((~seed1 << 0x15) + 0x11111111) | (seed1 >> 0x0B)
-            seed1 &= 0xFFFFFFFF
+            seed1 = (((~seed1 << 0x15) + 0x11111111) | (seed1 >> 0x0B)
+                     ) & 0xFFFFFFFF
             seed2 = value + seed2 + (seed2 << 5) + 3 & 0xFFFFFFFF
 
-            result.write(struct.pack("<I", value))
+            append(value)
 
-        return result.getvalue()
+        result = array.array(_UINT32, result)
+        if sys.byteorder == 'big':
+            result.byteswap()
+        return result.tostring()
 
-    def _prepare_encryption_table():
-        """Prepare encryption table for MPQ hash function."""
-        seed = 0x00100001
-        crypt_table = {}
+    encryption_table = ENCRYPTION_TABLE
 
-        for i in range(256):
-            index = i
-            for j in range(5):
-                seed = (seed * 125 + 3) % 0x2AAAAB
-                temp1 = (seed & 0xFFFF) << 0x10
 
-                seed = (seed * 125 + 3) % 0x2AAAAB
-                temp2 = (seed & 0xFFFF)
+def _prepare_encryption_table():
+    """Prepare encryption table for MPQ hash function.
 
-                crypt_table[index] = (temp1 | temp2)
+    The table is shipped precomputed as mpyq_table.ENCRYPTION_TABLE; this
+    is kept to check and regenerate it.
+    """
+    seed = 0x00100001
+    crypt_table = [0] * 0x500
 
-                index += 0x100
+    for i in range(256):
+        index = i
+        for j in range(5):
+            seed = (seed * 125 + 3) % 0x2AAAAB
+            temp1 = (seed & 0xFFFF) << 0x10
 
-        return crypt_table
+            seed = (seed * 125 + 3) % 0x2AAAAB
+            temp2 = (seed & 0xFFFF)
 
-    encryption_table = _prepare_encryption_table()
+            crypt_table[index] = (temp1 | temp2)
+
+            index += 0x100
+
+    return crypt_table
 
 
 def main():
+    from third_party import argparse
+
     description = "mpyq reads and extracts MPQ archives."
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument("file", action="store", help="path to the archive")
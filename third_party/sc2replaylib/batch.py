@@ -0,0 +1,79 @@
+"""Parse a batch of replays at once.
+
+Each replay is parsed in a worker process when the runtime allows it. Sandboxed
+runtimes, App Engine among them, can't fork, so there the replays are parsed one
+after another in the calling process.
+"""
+
+import logging
+
+from cStringIO import StringIO
+
+from third_party.sc2replaylib import Sc2replaylibException
+from third_party.sc2replaylib.replay import Replay
+
+class ReplayParseError(Sc2replaylibException):
+  """A replay in the batch could not be parsed.
+
+  Stands in for whatever the parser raised, which may not survive the trip back
+  from a worker process.
+  """
+  pass
+
+def parse_summary(data):
+  """Parses one replay held in a string and returns its summary.
+
+  :param data: The contents of a replay file
+  :type data: String
+  :rtype: ReplaySummary
+  """
+  replay = Replay(StringIO(data))
+  summary = replay.summary()
+  replay.release()
+  return summary
+
+def _parse_or_error(data):
+  try:
+    return parse_summary(data)
+  except Exception, e:
+    return ReplayParseError('%s: %s' % (e.__class__.__name__, e))
+
+def _make_pool(processes, jobs):
+  """A pool of at most one worker per job, or None if a pool wouldn't have
+  more than one worker or can't be made."""
+  try:
+    import multiprocessing
+    processes = min(processes or multiprocessing.cpu_count(), jobs)
+    if processes <= 1:
+      return None
+    return multiprocessing.Pool(processes)
+  except (ImportError, NotImplementedError, OSError, AttributeError), e:
+    logging.debug("no process pool (%s), parsing replays sequentially", e)
+    return None
+
+def parse_replays(buffers, processes=None):
+  """Parses a list of replays held in strings.
+
+  Returns one entry per replay, in input order: its :class:`ReplaySummary`, or a
+  :class:`ReplayParseError` instance if it couldn't be parsed. A bad replay never
+  stops the rest of the batch.
+
+  :param buffers: The contents of each replay file
+  :type buffers: List of String
+  :param processes: Number of worker processes, ``None`` for one per CPU. Pass ``0``
+    to parse sequentially in this process.
+  :rtype: List
+  """
+  buffers = list(buffers)
+  pool = None
+  if len(buffers) > 1 and processes != 0:
+    pool = _make_pool(processes, len(buffers))
+
+  if pool is None:
+    return [_parse_or_error(data) for data in buffers]
+
+  try:
+    return pool.map(_parse_or_error, buffers, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
@@ -6,17 +6,31 @@ class AttributesParser(Parser):
 
 	ATTRIB_BYTE_SIZE		= 13
 	ATTRIB_HEADER_OFFSET	= 9
+	ATTRIB_FORMAT			= 'IIB4s'
+	ATTRIB_STRUCT			= struct.Struct('<' + ATTRIB_FORMAT)
 
 	def __init__(self, raw_data):
 		self.raw_data = raw_data
 		self.parsed_data = None
+		self.index = None
+		self.players = None
 
 	def parse(self):
 		if self.parsed_data == None:
-		 	self.parsed_data = self.parse_events(self.raw_data)
+			self.parsed_data = self.parse_events(self.raw_data)
+			self.index_events(self.parsed_data)
 
 		return self.parsed_data
 
+	def attribute(self, player_num, key):
+		"""Returns the value of attribute key for player_num, or None."""
+		self.parse()
+		return self.index.get((player_num, key))
+
+	def player_attributes(self, player_num):
+		"""Returns all attribute records belonging to player_num."""
+		self.parse()
+		return self.players.get(player_num, [])
 
 	def unpack_int32(self, data):
 		return struct.unpack_from('<I', data)[0]
@@ -42,13 +56,26 @@ class AttributesParser(Parser):
 		#                   ^ 5 bytes of zeros  ^ 4 byte int of total attribute length
 		self.length = self.unpack_int32(data[5:9])
 
-		# parse 13 byte blocks until self.length is met
-		i = 0
+		# the count comes from the file, so check it fits before unpacking.
+		if self.ATTRIB_HEADER_OFFSET + self.ATTRIB_BYTE_SIZE * self.length > len(data):
+			raise ParserException('Could not parse attributes: %d records claimed in %d bytes'
+				% (self.length, len(data)))
+
+		unpack_from = self.ATTRIB_STRUCT.unpack_from
 		parsed = []
-		while i < self.length:
-			parsed.append(self.parse_attribute(data[
-				self.ATTRIB_HEADER_OFFSET+(self.ATTRIB_BYTE_SIZE*i):
-				self.ATTRIB_HEADER_OFFSET+(self.ATTRIB_BYTE_SIZE*(i+1))]))
-			i += 1
+		for offset in xrange(self.ATTRIB_HEADER_OFFSET,
+				self.ATTRIB_HEADER_OFFSET + self.ATTRIB_BYTE_SIZE * self.length,
+				self.ATTRIB_BYTE_SIZE):
+			(header, key, player, value) = unpack_from(data, offset)
+			parsed.append((header, key, player, value[::-1].replace('\x00','')))
 
 		return tuple(parsed)
+
+	# builds lookups by (player, attribute id) and by player. the first record
+	# wins if an attribute shows up twice, like a linear search would.
+	def index_events(self, parsed):
+		self.index = {}
+		self.players = {}
+		for attr in parsed:
+			self.index.setdefault((attr[2], attr[1]), attr[3])
+			self.players.setdefault(attr[2], []).append(attr)
@@ -19,21 +19,26 @@ class DetailsParser(Parser):
 
 		return self.parsed_data
 
-	# Recursive function to parse_details
-	def parse_details(self, data):
-		i = 0
+	# Recursive function to parse_details. Walks data from offset i without
+	# slicing it and returns the value along with the offset just past it.
+	def parse_details(self, data, i=0):
+
+		try:
+			data_type = data[i]
+		except IndexError:
+			raise ParserException('Ran out of data at offset %d' % i)
 
 		# \x02 binary data
-		if(data[i] == self.DETAILS_TYPE_BIN):
+		if(data_type == self.DETAILS_TYPE_BIN):
 			i += 1
 
-			(length, movement) = self.parse_number(data[i:])
-			i += movement + 1
+			(length, i) = self.parse_number(data, i)
+			i += 1
 
 			return (data[i : i + length], i + length)
 
 		# \x04 array
-		elif(data[i] == self.DETAILS_TYPE_ARRAY):
+		elif(data_type == self.DETAILS_TYPE_ARRAY):
 
 			# \x01 should follow identifyer...
 			i += 1
@@ -47,30 +52,23 @@ class DetailsParser(Parser):
 
 			# ... then length
 			i += 1
-			(length, movement) = self.parse_number(data[i:])
-			i += movement + 1
+			(length, i) = self.parse_number(data, i)
+			i += 1
 
-			# move up i to the data!
-			j = 0
 			return_array = []
 
-			while j < length:
-
-				(new_data, movement) = self.parse_details(data[i:])
-				i += movement
-
+			for j in xrange(length):
+				(new_data, i) = self.parse_details(data, i)
 				return_array.append(new_data)
 
-				j += 1
-
 			return (return_array, i)
 
 		# \x05 Indexed array
-		elif(data[i] == self.DETAILS_TYPE_INDEXED_ARRAY):
+		elif(data_type == self.DETAILS_TYPE_INDEXED_ARRAY):
 			i += 1
 
-			(length, movement) = self.parse_number(data[i:])
-			i += movement + 1
+			(length, i) = self.parse_number(data, i)
+			i += 1
 
 			return_array = []
 			nulls = 0
@@ -79,8 +77,8 @@ class DetailsParser(Parser):
 			while (curr_idx - nulls) < length:
 
 				# get index and check for 'null' entries - THEY DO NOT COUNT AGAINST ARRAY LENGTH
-				(idx, movement) = self.parse_number(data[i:])
-				i += movement + 1
+				(idx, i) = self.parse_number(data, i)
+				i += 1
 
 				while idx > (curr_idx):
 					return_array.append(None)
@@ -88,48 +86,52 @@ class DetailsParser(Parser):
 					nulls += 1
 
 				curr_idx = idx
-				(new_data, movement) = self.parse_details(data[i:])
-				i += movement
+				(new_data, i) = self.parse_details(data, i)
 
 				return_array.append(new_data)
 				curr_idx += 1
 
 			return (return_array, i)
 
-		elif(data[i] == self.DETAILS_TYPE_TINYINT):
+		elif(data_type == self.DETAILS_TYPE_TINYINT):
 			i += 1
 			return (ord(data[i]), i + 1)
 
 		#\x07 Big Integer
-		elif(data[i] == self.DETAILS_TYPE_BIGINT):
+		elif(data_type == self.DETAILS_TYPE_BIGINT):
 			i += 1
 
-			hex_str = hex(ord(data[i])) + str(hex(ord(data[i+1]))[2:]) + str(hex(ord(data[i+2]))[2:]) + str(hex(ord(data[i+3]))[2:])
+			# The bytes after the first are joined as unpadded hex digits, so
+			# e.g. 01 02 03 04 reads as 0x1234. Replay identifiers are hashed
+			# from these values, so keep decoding them the same way.
+			hex_str = hex(ord(data[i])) + hex(ord(data[i+1]))[2:] + hex(ord(data[i+2]))[2:] + hex(ord(data[i+3]))[2:]
 
 			return (int(hex_str, 16), i+4)
 
 		# \x09 VLF number found
-		elif(data[i] == self.DETAILS_TYPE_VLF):
+		elif(data_type == self.DETAILS_TYPE_VLF):
 			i += 1
 
-			(value, movement) = self.parse_number(data[i:])
-			return (value, i + movement+1)
+			(value, i) = self.parse_number(data, i)
+			return (value, i + 1)
 
-	def parse_number(self, data):
-		i = 0
+		raise ParserException('Unknown details type %r at offset %d' % (data_type, i))
+
+	# Parses a variable length number starting at offset i. Returns the value
+	# and the offset of the last byte belonging to the number.
+	def parse_number(self, data, i=0):
+		value = 0
+		shift = 0
 
 		# is the next byte going to be influential on this number?
-		while ord(data[i]) & 0x80 == 0x80:
+		byte = ord(data[i])
+		while byte & 0x80 == 0x80:
+			value |= (byte & 0x7F) << shift
+			shift += 7
 			i += 1
+			byte = ord(data[i])
 
-		value = ord(data[i]) & 0x7F
-
-		j = i-1
-		while j >= 0:
-			bit = ord(data[j]) & 0x7F
-			value = value << 7
-			value = value | bit
-			j -= 1
+		value |= (byte & 0x7F) << shift
 
 		if value & 1 == 1:
 			value = (value >> 1) * -1
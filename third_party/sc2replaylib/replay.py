@@ -4,12 +4,36 @@ import logging
 
 from datetime import datetime
 
+from third_party.collections26 import namedtuple
 from third_party.mpyq import MPQArchive
 
 from third_party.sc2replaylib import Sc2replaylibException
 from third_party.sc2replaylib.parsers.attributes import AttributesParser
 from third_party.sc2replaylib.parsers.details import DetailsParser
 
+ReplaySummary = namedtuple('ReplaySummary',
+  '''
+  identifier
+  game_teams
+  winners
+  losers
+  map_name
+  timestamp
+  timestamp_local
+  duration
+  version
+  '''
+)
+
+PlayerSummary = namedtuple('PlayerSummary',
+  '''
+  handle
+  bnet_id
+  race
+  color_name
+  '''
+)
+
 class Replay:
   """
   This class, once initialized with a valid replay file, contains all the data about the given replay
@@ -53,26 +77,25 @@ class Replay:
     self.replay_file    = replay_file
 
     self.parsers      = {}
+    self.files        = None
+    self._summary     = None
 
     try:
-      archive = MPQArchive(self.replay_file)
+      archive = MPQArchive(self.replay_file, listfile=False)
 
-      files = archive.extract()
+      # files are only decompressed when first looked up, so the large event
+      # streams we never parse are left alone.
+      self.files = archive.extract(lazy=True)
 
       # bootstrap the right parsers, expand here for different version parsing too
 
       self.parsers['header'] = DetailsParser(archive.header['user_data_header']['content'])
 
-      for file_name, data in files.iteritems():
-        #logging.info("replay file %s" % file_name)
-        if(file_name == self.FILES['attributes']):
-          self.parsers[file_name] = AttributesParser(data)
-
-        if(file_name == self.FILES['details']):
-          self.parsers[file_name] = DetailsParser(data)
+      self.parsers[self.FILES['attributes']] = AttributesParser(
+        self.files[self.FILES['attributes']])
 
-        if (file_name == self.FILES['game']):
-          self.parsers[file_name] = data
+      self.parsers[self.FILES['details']] = DetailsParser(
+        self.files[self.FILES['details']])
 
       teams = self.attribute(2001)
       num_teams = 2
@@ -112,6 +135,51 @@ class Replay:
     except:
       raise
 
+  def summary(self):
+    """Everything a ladder keeps about the replay, gathered into one immutable record.
+
+    The record is built on the first call and reused afterwards, so it can be passed around
+    and cached in place of the replay itself. ``winners`` and ``losers`` are tuples of
+    :class:`PlayerSummary` records, or ``None`` if no team won.
+
+    :rtype: ReplaySummary
+    """
+    if self._summary is None:
+      winners = losers = None
+      if self.teams[0].outcome() == 'Won':
+        (winners, losers) = (self.teams[0], self.teams[1])
+      elif self.teams[1].outcome() == 'Won':
+        (winners, losers) = (self.teams[1], self.teams[0])
+
+      if winners:
+        winners = tuple(PlayerSummary(p.handle(), p.bnet_id(), p.race(), p.color_name())
+          for p in winners.players)
+        losers = tuple(PlayerSummary(p.handle(), p.bnet_id(), p.race(), p.color_name())
+          for p in losers.players)
+
+      self._summary = ReplaySummary(
+        identifier=self.identifier(),
+        game_teams=self.game_teams(),
+        winners=winners,
+        losers=losers,
+        map_name=self.map_human_friendly(),
+        timestamp=self.timestamp(),
+        timestamp_local=self.timestamp_local(),
+        duration=self.duration(),
+        version=tuple(self.version()))
+    return self._summary
+
+  def release(self):
+    """Drops the replay file, archive and parser buffers once the summary has been built.
+
+    Only :meth:`summary` keeps working afterwards.
+    """
+    self.summary()
+    self.teams = []
+    self.parsers = {}
+    self.files = None
+    self.replay_file = None
+
   def attribute(self, key):
     """Get a single attribute by it's key
 
@@ -124,10 +192,9 @@ class Replay:
     :raise Sc2ReplaylibException: If no attribute is found then this exception is raised
     """
 
-    attributes = self.attributes()
-    for attr in attributes:
-      if attr[1] == key:
-        return attr[3]
+    value = self.parsers[self.FILES['attributes']].attribute(16, key)
+    if value is not None:
+      return value
 
     # no attribute found!
     raise Sc2replaylibException("no global attribute found with key '%d'" % (key))
@@ -142,12 +209,7 @@ class Replay:
     :rtype: List
     """
 
-    rc = []
-    attributes = self.parsers[self.FILES['attributes']].parse()
-    for attrib in attributes:
-      if attrib[2] == player_num:
-        rc.append(attrib)
-    return rc
+    return self.parsers[self.FILES['attributes']].player_attributes(player_num)
 
   def attributes(self):
     """Retrieve a list of *global attributes*"""
@@ -233,9 +295,20 @@ class Replay:
     for s in self.parsers[self.FILES['details']].parse()[0]:
       id.update(str(s))
     id.update(str(self.parsers[self.FILES['attributes']].parse()))
-    id.update(self.parsers[self.FILES['game']][:22])
+    id.update(self.game_events_prefix(22))
     return id.hexdigest()
 
+  def game_events_prefix(self, length):
+    """Returns the first bytes of the game events stream.
+
+    Only the sectors covering those bytes are decompressed.
+
+    :param length: The number of bytes wanted
+    :type length: Integer
+    :rtype: String --- Raw
+    """
+    return self.files.read_prefix(self.FILES['game'], length)
+
   def version(self):
     """Holds a list containing the version numbers for the copy of Starcraft 2 that recorded the replay.
 
@@ -399,6 +472,11 @@ class Player:
     self.details  = details
     self.attributes = attributes
 
+    # index by key once, first record wins.
+    self.attribute_index = {}
+    for attr in attributes:
+      self.attribute_index.setdefault(attr[1], attr[3])
+
   def type(self, raw=False):
     """Returns the type of player this is.
 
@@ -537,9 +615,8 @@ class Player:
     :raise Sc2ReplaylibException: If no attribute is found then this exception is raised
     """
 
-    for attr in self.attributes:
-      if attr[1] == key:
-        return attr[3]
+    if key in self.attribute_index:
+      return self.attribute_index[key]
 
     # no attribute found!
-    raise Sc2replaylibException("no attribute found for player '%d' with key '%d'" % (attr[2], key))
+    raise Sc2replaylibException("no attribute found for player '%s' with key '%d'" % (self.handle(), key))
@@ -0,0 +1,37 @@
+"""Compares sequential and pooled parsing of a directory of replays.
+
+Run from the application root:
+
+	python -m third_party.sc2replaylib.test.bench_batch <corpus dir> [processes] [runs]
+"""
+
+import sys
+import time
+
+from third_party.sc2replaylib.batch import parse_replays
+from third_party.sc2replaylib.test.test_batch import corpus_buffers
+
+
+def best_time(buffers, processes, runs):
+	"""Best wall time to parse the whole batch over a number of runs."""
+	times = []
+	for i in range(runs):
+		start = time.time()
+		parse_replays(buffers, processes)
+		times.append(time.time() - start)
+	return min(times)
+
+
+def main():
+	processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+	runs = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+	buffers = corpus_buffers(sys.argv[1])
+	sequential = best_time(buffers, 0, runs)
+	pooled = best_time(buffers, processes, runs)
+	print "%d replays" % len(buffers)
+	print "sequential:    %8.1f ms" % (sequential * 1000)
+	print "process pool:  %8.1f ms  (%.1fx)" % (pooled * 1000, sequential / pooled)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,44 @@
+import struct
+import time
+import unittest
+
+from third_party.sc2replaylib.parsers import ParserException
+from third_party.sc2replaylib.parsers.attributes import AttributesParser
+
+
+def attributes_block(records, count=None):
+	"""An attributes block holding records of (header, key, player, value),
+	claiming count records if given."""
+	if count is None:
+		count = len(records)
+	return '\x00' * 5 + struct.pack('<I', count) + ''.join(
+		struct.pack('<IIB4s', header, key, player, value[::-1].ljust(4, '\x00')[:4])
+		for (header, key, player, value) in records)
+
+
+class AttributesParserTest(unittest.TestCase):
+
+	def testRecords(self):
+		parser = AttributesParser(attributes_block([
+			(999, 3001, 1, 'Humn'), (999, 3009, 2, '1v1'), (999, 3001, 1, 'Comp')]))
+		self.assertEqual(parser.parse(), (
+			(999, 3001, 1, 'Humn'), (999, 3009, 2, '1v1'), (999, 3001, 1, 'Comp')))
+		self.assertEqual(parser.attribute(1, 3001), 'Humn')
+		self.assertEqual(parser.attribute(2, 3009), '1v1')
+		self.assertEqual(len(parser.player_attributes(1)), 2)
+
+	def testShortBlock(self):
+		data = attributes_block([(999, 3001, 1, 'Humn')], count=2)
+		self.assertRaises(ParserException, AttributesParser(data).parse)
+
+	def testHugeRecordCount(self):
+		"""A block claiming far more records than it holds fails at once."""
+		for count in (50000000, 0xFFFFFFFF):
+			data = attributes_block([(999, 3001, 1, 'Humn')] * 2, count=count)
+			start = time.time()
+			self.assertRaises(ParserException, AttributesParser(data).parse)
+			self.assertTrue(time.time() - start < 0.1)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,64 @@
+import os
+import unittest
+
+from third_party.sc2replaylib import batch
+from third_party.sc2replaylib.batch import parse_replays, parse_summary, ReplayParseError
+
+# Directory of .SC2Replay files to parse, if available.
+CORPUS = os.environ.get('SC2REPLAY_CORPUS')
+
+
+def corpus_buffers(corpus):
+	"""Contents of every replay in a directory."""
+	buffers = []
+	for name in sorted(os.listdir(corpus)):
+		if name.lower().endswith('.sc2replay'):
+			buffers.append(open(os.path.join(corpus, name), 'rb').read())
+	return buffers
+
+
+class ParseReplaysTest(unittest.TestCase):
+
+	def testErrorsStayInPlace(self):
+		results = parse_replays(['', 'not a replay', 'MPQ\x1a'], processes=0)
+		self.assertEqual(len(results), 3)
+		for result in results:
+			self.assertTrue(isinstance(result, ReplayParseError))
+
+	def testPooledErrorsStayInPlace(self):
+		"""Errors from pool workers come back in input order."""
+		buffers = ['', 'MPQ\x1a', 'MPQ\x1a' + '\x00' * 28, 'not a replay',
+			'MPQ\x1a' + '\x00' * 28, 'MPQ\x1b']
+		expected = parse_replays(buffers, processes=0)
+		# the buffers fail in different ways, so order shows in the messages.
+		self.assertTrue(len(set([repr(r) for r in expected])) > 2)
+		pooled = parse_replays(buffers, processes=2)
+		self.assertEqual(len(pooled), len(buffers))
+		for result in pooled:
+			self.assertTrue(isinstance(result, ReplayParseError))
+		self.assertEqual([repr(r) for r in pooled], [repr(r) for r in expected])
+
+	def testNoPoolForOneWorker(self):
+		"""A pool is only made when it would have more than one worker."""
+		self.assertEqual(batch._make_pool(None, 1), None)
+		self.assertEqual(batch._make_pool(4, 1), None)
+		self.assertEqual(batch._make_pool(1, 10), None)
+
+	def testCorpus(self):
+		"""Pooled and sequential parsing agree with parsing one by one."""
+		if not CORPUS:
+			self.skipTest('SC2REPLAY_CORPUS is not set')
+		buffers = corpus_buffers(CORPUS)
+		bad = len(buffers) // 2
+		buffers.insert(bad, 'not a replay')
+		expected = parse_replays(buffers, processes=0)
+		self.assertTrue(isinstance(expected[bad], ReplayParseError))
+		for (data, summary) in zip(buffers, expected):
+			if not isinstance(summary, ReplayParseError):
+				self.assertEqual(summary, parse_summary(data))
+		pooled = parse_replays(buffers, processes=2)
+		self.assertEqual([repr(r) for r in pooled], [repr(r) for r in expected])
+
+
+if __name__ == '__main__':
+	unittest.main()
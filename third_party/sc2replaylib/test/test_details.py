@@ -0,0 +1,234 @@
+import os
+import random
+import struct
+import unittest
+
+from third_party.mpyq import MPQArchive
+from third_party.sc2replaylib.parsers import ParserException
+from third_party.sc2replaylib.parsers.details import DetailsParser
+
+# Directory of .SC2Replay files to compare the parsers on, if available.
+CORPUS = os.environ.get('SC2REPLAY_CORPUS')
+
+
+class LegacyDetailsParser(DetailsParser):
+	"""The original slicing parser, kept as the reference implementation."""
+
+	# Recursive function to parse_details
+	def parse_details(self, data):
+		i = 0
+
+		# \x02 binary data
+		if(data[i] == self.DETAILS_TYPE_BIN):
+			i += 1
+
+			(length, movement) = self.parse_number(data[i:])
+			i += movement + 1
+
+			return (data[i : i + length], i + length)
+
+		# \x04 array
+		elif(data[i] == self.DETAILS_TYPE_ARRAY):
+
+			# \x01 should follow identifyer...
+			i += 1
+			if data[i] != '\x01':
+				raise ParserException('This should have been \x01 in array')
+
+			# ... then \x00
+			i += 1
+			if data[i] != '\x00':
+				raise ParserException('This should have been \x00 in array')
+
+			# ... then length
+			i += 1
+			(length, movement) = self.parse_number(data[i:])
+			i += movement + 1
+
+			# move up i to the data!
+			j = 0
+			return_array = []
+
+			while j < length:
+
+				(new_data, movement) = self.parse_details(data[i:])
+				i += movement
+
+				return_array.append(new_data)
+
+				j += 1
+
+			return (return_array, i)
+
+		# \x05 Indexed array
+		elif(data[i] == self.DETAILS_TYPE_INDEXED_ARRAY):
+			i += 1
+
+			(length, movement) = self.parse_number(data[i:])
+			i += movement + 1
+
+			return_array = []
+			nulls = 0
+			curr_idx = 0
+
+			while (curr_idx - nulls) < length:
+
+				# get index and check for 'null' entries - THEY DO NOT COUNT AGAINST ARRAY LENGTH
+				(idx, movement) = self.parse_number(data[i:])
+				i += movement + 1
+
+				while idx > (curr_idx):
+					return_array.append(None)
+					curr_idx += 1
+					nulls += 1
+
+				curr_idx = idx
+				(new_data, movement) = self.parse_details(data[i:])
+				i += movement
+
+				return_array.append(new_data)
+				curr_idx += 1
+
+			return (return_array, i)
+
+		elif(data[i] == self.DETAILS_TYPE_TINYINT):
+			i += 1
+			return (ord(data[i]), i + 1)
+
+		#\x07 Big Integer
+		elif(data[i] == self.DETAILS_TYPE_BIGINT):
+			i += 1
+
+			hex_str = hex(ord(data[i])) + str(hex(ord(data[i+1]))[2:]) + str(hex(ord(data[i+2]))[2:]) + str(hex(ord(data[i+3]))[2:])
+
+			return (int(hex_str, 16), i+4)
+
+		# \x09 VLF number found
+		elif(data[i] == self.DETAILS_TYPE_VLF):
+			i += 1
+
+			(value, movement) = self.parse_number(data[i:])
+			return (value, i + movement+1)
+
+	def parse_number(self, data):
+		i = 0
+
+		# is the next byte going to be influential on this number?
+		while ord(data[i]) & 0x80 == 0x80:
+			i += 1
+
+		value = ord(data[i]) & 0x7F
+
+		j = i-1
+		while j >= 0:
+			bit = ord(data[j]) & 0x7F
+			value = value << 7
+			value = value | bit
+			j -= 1
+
+		if value & 1 == 1:
+			value = (value >> 1) * -1
+		else:
+			value = (value >> 1)
+
+		return (value, i)
+
+
+def encode_number(value):
+	value = (abs(value) << 1) | (1 if value < 0 else 0)
+	out = []
+	while value > 0x7F:
+		out.append(chr(value & 0x7F | 0x80))
+		value >>= 7
+	out.append(chr(value))
+	return ''.join(out)
+
+
+def encode(value):
+	"""Encodes a value the way replay.details stores it.
+
+	Strings become binary data, lists arrays, dicts indexed arrays (missing
+	indexes are nulls), ('tiny', n) and ('big', n) the fixed size integers and
+	any other integer a variable length number.
+	"""
+	if isinstance(value, str):
+		return '\x02' + encode_number(len(value)) + value
+	if isinstance(value, list):
+		return '\x04\x01\x00' + encode_number(len(value)) + ''.join(
+			encode(v) for v in value)
+	if isinstance(value, dict):
+		return '\x05' + encode_number(len(value)) + ''.join(
+			encode_number(k) + encode(v) for (k, v) in sorted(value.items()))
+	if isinstance(value, tuple) and value[0] == 'tiny':
+		return '\x06' + chr(value[1])
+	if isinstance(value, tuple) and value[0] == 'big':
+		return '\x07' + struct.pack('>I', value[1])
+	return '\x09' + encode_number(value)
+
+
+def random_value(rand, depth=0):
+	kind = rand.randint(0, 6 if depth < 4 else 3)
+	if kind == 0:
+		return ''.join(chr(rand.randint(0, 255)) for i in range(rand.randint(0, 300)))
+	if kind == 1:
+		return ('tiny', rand.randint(0, 255))
+	if kind == 2:
+		return ('big', rand.randint(0, 0xFFFFFFFF))
+	if kind == 3:
+		return rand.randint(-2**40, 2**40)
+	if kind == 4:
+		return [random_value(rand, depth + 1) for i in range(rand.randint(0, 8))]
+	return dict((k, random_value(rand, depth + 1))
+		for k in rand.sample(range(20), rand.randint(0, 10)))
+
+
+class DetailsParserTest(unittest.TestCase):
+
+	def assertParsesLikeLegacy(self, data):
+		self.assertEqual(DetailsParser(data).parse(), LegacyDetailsParser(data).parse())
+
+	def testNumbers(self):
+		"""Variable length numbers decode like before, signs included."""
+		for value in (0, 1, -1, 63, -64, 64, 127, 128, 8191, 8192, -8192, 2**35, -2**35):
+			self.assertParsesLikeLegacy(encode(value))
+			self.assertEqual(DetailsParser(encode(value)).parse(), value)
+
+	def testBigInt(self):
+		"""Big integers keep their historical (unpadded hex) decoding."""
+		for value in (0x01020304, 0x10203040, 0xFFFFFFFF, 0x00000001):
+			self.assertParsesLikeLegacy(encode(('big', value)))
+
+	def testNestedStructures(self):
+		"""Randomly generated nested structures parse like before."""
+		rand = random.Random(42)
+		for i in range(200):
+			self.assertParsesLikeLegacy(encode(random_value(rand)))
+
+	def testUnknownType(self):
+		"""Both parsers reject an unknown type byte, at the top level or nested;
+		the new one with a ParserException."""
+		nested = '\x04\x01\x00' + encode_number(2) + encode(1) + '\x0b'
+		for data in ('\x01', nested):
+			self.assertRaises(ParserException, DetailsParser(data).parse)
+			self.assertRaises(Exception, LegacyDetailsParser(data).parse)
+
+	def testBadArrayMarkers(self):
+		"""Both parsers raise ParserException for a malformed array header."""
+		for data in ('\x04\x02\x00\x00', '\x04\x01\x01\x00'):
+			self.assertRaises(ParserException, DetailsParser(data).parse)
+			self.assertRaises(ParserException, LegacyDetailsParser(data).parse)
+
+	def testCorpus(self):
+		"""Headers and details of real replays parse like before."""
+		if not CORPUS:
+			self.skipTest('SC2REPLAY_CORPUS is not set')
+		for name in sorted(os.listdir(CORPUS)):
+			if not name.lower().endswith('.sc2replay'):
+				continue
+			archive = MPQArchive(os.path.join(CORPUS, name), listfile=False)
+			self.assertParsesLikeLegacy(archive.header['user_data_header']['content'])
+			self.assertParsesLikeLegacy(archive.read_file('replay.details'))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,111 @@
+"""Times rating a busy period, and replaying a ladder's match history, one
+Player at a time against the batch engines.
+
+Run from the application root:
+
+    python -m third_party.test.bench_glicko2 [players] [games] [runs]
+"""
+
+import random
+import sys
+import timeit
+
+from third_party import glicko2
+from third_party.test.test_glicko2 import (random_period, rate_with_engine,
+                                           rate_with_players)
+
+
+def random_history(rand, num_players, num_matches, num_periods):
+    """Matches as (period, winners, losers), 1v1 and 2v2, in period order."""
+    matches = []
+    for i in range(num_matches):
+        team_size = rand.choice((1, 1, 2))
+        players = rand.sample(range(num_players), team_size * 2)
+        matches.append((rand.randrange(num_periods), players[:team_size],
+                        players[team_size:]))
+    matches.sort()
+    return matches
+
+
+def replay_with_players(num_players, matches, num_periods):
+    """Replays the history with Player objects, the way the ladder used to."""
+    players = [glicko2.Player() for i in range(num_players)]
+    games = [([], [], []) for p in players]
+    i = 0
+    for period in range(num_periods):
+        while i < len(matches) and matches[i][0] == period:
+            (_, winners, losers) = matches[i]
+            for (team, others, outcome) in ((winners, losers, 1),
+                                            (losers, winners, 0)):
+                rating = sum([players[p].rating for p in others]) / len(team)
+                rd = sum([players[p].rd for p in others])
+                for p in team:
+                    games[p][0].append(rating)
+                    games[p][1].append(rd)
+                    games[p][2].append(outcome)
+            i += 1
+        for (player, (ratings, rds, outcomes)) in zip(players, games):
+            if ratings:
+                player.update_player(ratings, rds, outcomes)
+            else:
+                player.did_not_compete()
+        games = [([], [], []) for p in players]
+    return players
+
+
+def replay_with_ratings(num_players, matches, num_periods):
+    """Replays the history with Ratings and one rate_ratings per period."""
+    players = [glicko2.Rating() for i in range(num_players)]
+    offset = 1500.0 / glicko2.SCALE
+    i = 0
+    for period in range(num_periods):
+        game_players = []
+        opp_mus = []
+        opp_gs = []
+        outcomes = []
+        while i < len(matches) and matches[i][0] == period:
+            (_, winners, losers) = matches[i]
+            for (team, others, outcome) in ((winners, losers, 1),
+                                            (losers, winners, 0)):
+                mu = (sum([players[p].mu for p in others]) +
+                      (len(others) - len(team)) * offset) / len(team)
+                g = glicko2.g(sum([players[p].phi for p in others]))
+                for p in team:
+                    game_players.append(p)
+                    opp_mus.append(mu)
+                    opp_gs.append(g)
+                    outcomes.append(outcome)
+            i += 1
+        glicko2.rate_ratings(players, game_players, opp_mus, opp_gs, outcomes)
+    return players
+
+
+def main():
+    num_players = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    num_games = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    runs = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    period = random_period(random.Random(0), num_players, num_games)
+    engines = [("glicko2.Player", lambda: rate_with_players(*period)),
+               ("rate_ratings, python", lambda: rate_with_engine(
+                   glicko2._rate_period_python, *period))]
+    if glicko2._load_numpy() is not None:
+        engines.append(("rate_ratings, numpy", lambda: rate_with_engine(
+            glicko2._rate_period_numpy, *period)))
+
+    print "one period, %d players, %d games" % (num_players, num_games)
+    for (name, rate) in engines:
+        best = min(timeit.repeat(rate, repeat=runs, number=1))
+        print "  %-22s %8.1f ms" % (name + ":", best * 1000)
+
+    # a ladder at MAX_UNFROZEN_MATCHES, replayed in full.
+    matches = random_history(random.Random(0), 60, 500, 26)
+    print "full replay, 60 players, 500 matches, 26 periods"
+    for (name, replay) in (("glicko2.Player", replay_with_players),
+                           ("Rating, rate_ratings", replay_with_ratings)):
+        best = min(timeit.repeat(lambda: replay(60, matches, 26),
+                                 repeat=runs, number=1))
+        print "  %-22s %8.1f ms" % (name + ":", best * 1000)
+
+
+if __name__ == '__main__':
+    main()
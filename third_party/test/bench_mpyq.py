@@ -0,0 +1,40 @@
+"""Measures how long a fresh interpreter takes to import mpyq.
+
+Run from the application root:
+
+    python -m third_party.test.bench_mpyq [runs]
+"""
+
+import subprocess
+import sys
+import timeit
+
+IMPORT_TIMER = """
+import time
+start = time.time()
+import third_party.mpyq
+print time.time() - start
+"""
+
+
+def import_time(runs):
+    """Best import time of mpyq over a number of fresh interpreters."""
+    times = []
+    for i in range(runs):
+        out = subprocess.Popen([sys.executable, '-c', IMPORT_TIMER],
+                               stdout=subprocess.PIPE).communicate()[0]
+        times.append(float(out))
+    return min(times)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    from third_party import mpyq
+    table_time = min(timeit.repeat(mpyq._prepare_encryption_table,
+                                   repeat=runs, number=1))
+    print "import third_party.mpyq:       %8.3f ms" % (import_time(runs) * 1000)
+    print "computing encryption table:    %8.3f ms" % (table_time * 1000)
+
+
+if __name__ == '__main__':
+    main()
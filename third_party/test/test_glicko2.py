@@ -0,0 +1,160 @@
+import random
+import subprocess
+import sys
+import unittest
+
+from third_party import glicko2
+
+
+def random_period(rand, num_players, num_games):
+    """Players and games of a rating period, as rate_period takes them."""
+    ratings = [rand.uniform(1000.0, 2200.0) for i in range(num_players)]
+    rds = [rand.uniform(30.0, 350.0) for i in range(num_players)]
+    vols = [rand.uniform(0.04, 0.09) for i in range(num_players)]
+    games = ([], [], [], [])
+    for i in range(num_games):
+        # leave the last player out so someone doesn't compete.
+        (a, b) = rand.sample(range(num_players - 1), 2)
+        outcome = rand.randint(0, 1)
+        for (player, opponent, score) in ((a, b, outcome), (b, a, 1 - outcome)):
+            games[0].append(player)
+            games[1].append(ratings[opponent])
+            games[2].append(rds[opponent])
+            games[3].append(score)
+    return (ratings, rds, vols) + games
+
+
+def rate_with_players(ratings, rds, vols, game_players, opp_ratings, opp_rds,
+                      outcomes):
+    """Rates the period one Player at a time, the reference results."""
+    players = [glicko2.Player(r, rd, vol) for (r, rd, vol)
+               in zip(ratings, rds, vols)]
+    games = [([], [], []) for p in players]
+    for (i, rating, rd, outcome) in zip(game_players, opp_ratings, opp_rds,
+                                        outcomes):
+        games[i][0].append(rating)
+        games[i][1].append(rd)
+        games[i][2].append(outcome)
+    for (player, (opp_ratings, opp_rds, outcomes)) in zip(players, games):
+        if opp_ratings:
+            player.update_player(opp_ratings, opp_rds, outcomes)
+        else:
+            player.did_not_compete()
+    return ([p.rating for p in players], [p.rd for p in players],
+            [p.vol for p in players])
+
+
+def rate_with_engine(engine, ratings, rds, vols, game_players, opp_ratings,
+                     opp_rds, outcomes):
+    """Runs a rate_ratings engine on a period given on the Glicko scale."""
+    players = [glicko2.Rating.from_glicko(r, rd, vol) for (r, rd, vol)
+               in zip(ratings, rds, vols)]
+    (mus, phis, vols, iterations) = engine(
+        [p.mu for p in players], [p.phi for p in players],
+        [p.vol for p in players], game_players,
+        [(r - 1500.0) / glicko2.SCALE for r in opp_ratings],
+        [glicko2.g(rd / glicko2.SCALE) for rd in opp_rds], outcomes,
+        glicko2.Player._tau)
+    players = [glicko2.Rating(mu, phi, vol) for (mu, phi, vol)
+               in zip(mus, phis, vols)]
+    return ([p.rating for p in players], [p.rd for p in players],
+            [p.vol for p in players], iterations)
+
+
+class VolatilityTest(unittest.TestCase):
+
+    def testGlickmanExample(self):
+        """The worked example from Glickman's Glicko-2 paper."""
+        player = glicko2.Player(1500.0, 200.0, 0.06)
+        player.update_player([1400.0, 1550.0, 1700.0], [30.0, 100.0, 300.0],
+                             [1, 0, 0])
+        # the paper rounds its intermediate values, hence the deltas.
+        self.assertAlmostEqual(player.rating, 1464.06, delta=0.01)
+        self.assertAlmostEqual(player.rd, 151.52, delta=0.01)
+        self.assertAlmostEqual(player.vol, 0.05999, delta=0.00001)
+        self.assertTrue(0 < player.vol_iterations < glicko2.MAX_VOL_ITERATIONS)
+
+    def testExtremeInputsSettle(self):
+        """Lopsided results from unrated players still converge quickly."""
+        for outcome in (0, 1):
+            player = glicko2.Player(1500.0, 350.0, 0.06)
+            player.update_player([3000.0] * 50, [10.0] * 50, [outcome] * 50)
+            self.assertTrue(player.vol_iterations < glicko2.MAX_VOL_ITERATIONS)
+            self.assertTrue(player.vol > 0.0)
+
+    def testEnginesCountIterations(self):
+        period = random_period(random.Random(3), 12, 40)
+        iterations = []
+        glicko2.rate_period(*period, **{'vol_iterations': iterations})
+        self.assertEqual(len(iterations), 12)
+        # the last player never competes.
+        self.assertEqual(iterations[-1], 0)
+        self.assertTrue(min(iterations[:-1]) > 0)
+        if glicko2._load_numpy() is not None:
+            numpy_iterations = rate_with_engine(
+                glicko2._rate_period_numpy, *period)[3]
+            self.assertEqual(numpy_iterations, iterations)
+
+
+class ImportTest(unittest.TestCase):
+
+    def testNumpyNotImportedUpFront(self):
+        """Importing glicko2 leaves NumPy alone until a big period needs it."""
+        out = subprocess.Popen([sys.executable, '-c',
+            "import sys; from third_party import glicko2; "
+            "print 'numpy' in sys.modules"],
+            stdout=subprocess.PIPE).communicate()[0]
+        self.assertEqual(out.strip(), 'False')
+
+
+class RatePeriodTest(unittest.TestCase):
+
+    def assertRatesLikePlayer(self, engine, period):
+        expected = rate_with_players(*period)
+        actual = rate_with_engine(engine, *period)
+        for (expected_values, actual_values) in zip(expected, actual):
+            self.assertEqual(len(expected_values), len(actual_values))
+            for (e, a) in zip(expected_values, actual_values):
+                self.assertAlmostEqual(e, a, places=7)
+
+    def testPython(self):
+        rand = random.Random(1)
+        for i in range(20):
+            self.assertRatesLikePlayer(glicko2._rate_period_python,
+                                       random_period(rand, 12, 40))
+
+    def testNumpy(self):
+        if glicko2._load_numpy() is None:
+            self.skipTest('numpy is not installed')
+        rand = random.Random(2)
+        for i in range(20):
+            self.assertRatesLikePlayer(glicko2._rate_period_numpy,
+                                       random_period(rand, 12, 40))
+
+    def testNoGames(self):
+        """Nobody competing only widens the rating deviations."""
+        period = ([1500.0, 1700.0], [350.0, 80.0], [0.06, 0.06], [], [], [], [])
+        self.assertRatesLikePlayer(glicko2._rate_period_python, period)
+        self.assertEqual(glicko2.rate_period(*period),
+                         rate_with_engine(glicko2._rate_period_python,
+                                          *period)[:3])
+
+    def testRateRatingsInPlace(self):
+        period = random_period(random.Random(4), 12, 40)
+        (ratings, rds, vols, game_players, opp_ratings, opp_rds,
+         outcomes) = period
+        players = [glicko2.Rating.from_glicko(r, rd, vol)
+                   for (r, rd, vol) in zip(ratings, rds, vols)]
+        glicko2.rate_ratings(
+            players, game_players,
+            [(r - 1500.0) / glicko2.SCALE for r in opp_ratings],
+            [glicko2.g(rd / glicko2.SCALE) for rd in opp_rds], outcomes)
+        expected = rate_with_players(*period)
+        for (player, rating, rd, vol) in zip(players, *expected):
+            self.assertAlmostEqual(player.rating, rating, places=7)
+            self.assertAlmostEqual(player.rd, rd, places=7)
+            self.assertAlmostEqual(player.vol, vol, places=7)
+
+
+if __name__ == '__main__':
+    unittest.main()
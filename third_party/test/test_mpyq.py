@@ -0,0 +1,255 @@
+import random
+import struct
+import unittest
+import zlib
+
+from cStringIO import StringIO
+
+from third_party import mpyq
+from third_party.mpyq_table import ENCRYPTION_TABLE
+
+# Sector size of a sector_size_shift of 0.
+SECTOR_SIZE = 512
+
+# Compressible data for the compressed files, random bytes for the rest.
+EVENTS = ''.join('event %05d;' % i for i in range(200))
+NOISE = ''.join(chr(random.Random(7).randint(0, 255)) for i in range(1300))
+
+# name, contents, compressed, single unit
+FIXTURE_FILES = [
+    ('replay.game.events', EVENTS, True, False),
+    ('replay.message.events', NOISE, False, False),
+    ('replay.details', EVENTS[:700], True, True),
+    ('replay.attributes.events', NOISE[:300], False, True),
+]
+
+
+def _hash(string, hash_type):
+    return mpyq.MPQArchive.__new__(mpyq.MPQArchive)._hash(string, hash_type)
+
+
+def _encrypt(data, key):
+    """The inverse of MPQArchive._decrypt."""
+    seed1 = key
+    seed2 = 0xEEEEEEEE
+    result = []
+    for value in struct.unpack('<%dI' % (len(data) / 4), data):
+        seed2 = (seed2 + ENCRYPTION_TABLE[0x400 + (seed1 & 0xFF)]) & 0xFFFFFFFF
+        result.append((value ^ (seed1 + seed2)) & 0xFFFFFFFF)
+        seed1 = (((~seed1 << 0x15) + 0x11111111) | (seed1 >> 0x0B)
+                 ) & 0xFFFFFFFF
+        seed2 = value + seed2 + (seed2 << 5) + 3 & 0xFFFFFFFF
+    return struct.pack('<%dI' % len(result), *result)
+
+
+def _build_block(data, compressed, single_unit):
+    if single_unit:
+        if compressed:
+            return '\x02' + zlib.compress(data)
+        return data
+    sectors = [data[i * SECTOR_SIZE:(i + 1) * SECTOR_SIZE]
+               for i in range(len(data) / SECTOR_SIZE + 1)]
+    if compressed:
+        sectors = ['\x02' + zlib.compress(sector) for sector in sectors]
+    positions = [4 * (len(sectors) + 1)]
+    for sector in sectors:
+        positions.append(positions[-1] + len(sector))
+    return struct.pack('<%dI' % len(positions), *positions) + ''.join(sectors)
+
+
+def build_archive(files=FIXTURE_FILES, duplicates=()):
+    """Builds an MPQ archive with 512 byte sectors and a listfile.
+
+    duplicates is a list of (name, index) pairs, each adding one more hash
+    table entry for name pointing at the index'th file.
+    """
+    files = list(files) + [
+        ('(listfile)', '\r\n'.join(f[0] for f in files), False, True)]
+    body = []
+    block_table = []
+    offset = 32
+    for (name, data, compressed, single_unit) in files:
+        block = _build_block(data, compressed, single_unit)
+        flags = mpyq.MPQ_FILE_EXISTS
+        if compressed:
+            flags |= mpyq.MPQ_FILE_COMPRESS
+        if single_unit:
+            flags |= mpyq.MPQ_FILE_SINGLE_UNIT
+        block_table.append((offset, len(block), len(data), flags))
+        body.append(block)
+        offset += len(block)
+
+    hash_table = [(0xFFFFFFFF, 0xFFFFFFFF, 0xFFFF, 0xFFFF, 0xFFFFFFFF)] * 16
+    entries = [(f[0], i) for (i, f) in enumerate(files)] + list(duplicates)
+    for (name, index) in entries:
+        slot = _hash(name, 'TABLE_OFFSET') & (len(hash_table) - 1)
+        while hash_table[slot][4] != 0xFFFFFFFF:
+            slot = (slot + 1) % len(hash_table)
+        hash_table[slot] = (_hash(name, 'HASH_A'), _hash(name, 'HASH_B'),
+                            0, 0, index)
+
+    hash_data = _encrypt(''.join(struct.pack('<2I2HI', *entry)
+                                 for entry in hash_table),
+                         _hash('(hash table)', 'TABLE'))
+    block_data = _encrypt(''.join(struct.pack('<4I', *entry)
+                                  for entry in block_table),
+                          _hash('(block table)', 'TABLE'))
+    header = struct.pack('<4s2I2H4I', 'MPQ\x1a', 32,
+                         offset + len(hash_data) + len(block_data), 0,
+                         0, offset,
+                         offset + len(hash_data), len(hash_table),
+                         len(block_table))
+    return header + ''.join(body) + hash_data + block_data
+
+
+def open_archive(data=None, listfile=True):
+    return mpyq.MPQArchive(StringIO(data or build_archive()), listfile)
+
+
+class EncryptionTableTest(unittest.TestCase):
+
+    def testTableMatchesAlgorithm(self):
+        """The shipped table is exactly what the crypt algorithm produces."""
+        self.assertEqual(list(ENCRYPTION_TABLE),
+                         mpyq._prepare_encryption_table())
+
+    def testArchiveUsesShippedTable(self):
+        """MPQArchive hashes with the precomputed table."""
+        self.assertTrue(mpyq.MPQArchive.encryption_table is ENCRYPTION_TABLE)
+
+    def testTableKeys(self):
+        """Hashing the table names gives the well known MPQ table keys."""
+        archive = mpyq.MPQArchive.__new__(mpyq.MPQArchive)
+        self.assertEqual(archive._hash('(hash table)', 'TABLE'), 0xC3AF3770)
+        self.assertEqual(archive._hash('(block table)', 'TABLE'), 0xEC83B3A3)
+
+
+class LazyFilesTest(unittest.TestCase):
+
+    def testSameFilesAsExtract(self):
+        """The lazy mapping holds the same files as an eager extract."""
+        archive = open_archive()
+        files = archive.extract(lazy=True)
+        eager = archive.extract()
+        self.assertEqual(sorted(files.keys()), sorted(eager.keys()))
+        for name in eager:
+            self.assertTrue(name in files)
+            self.assertEqual(files[name], eager[name])
+        for (name, data, compressed, single_unit) in FIXTURE_FILES:
+            self.assertEqual(files[name], data)
+
+    def testFilesReadOnFirstAccess(self):
+        archive = open_archive()
+        reads = []
+        read_file = archive.read_file
+        def counting_read_file(filename, max_bytes=None):
+            reads.append(filename)
+            return read_file(filename, max_bytes)
+        archive.read_file = counting_read_file
+        files = archive.extract(lazy=True)
+        self.assertEqual(reads, [])
+        files['replay.details']
+        files['replay.details']
+        self.assertEqual(reads, ['replay.details'])
+
+    def testMissingFile(self):
+        files = open_archive(listfile=False).extract(lazy=True)
+        self.assertRaises(KeyError, files.__getitem__, 'replay.sync.events')
+        self.assertFalse('replay.sync.events' in files)
+        self.assertEqual(files.get('replay.sync.events'), None)
+        self.assertEqual(files['replay.details'], EVENTS[:700])
+
+
+class PrefixReadTest(unittest.TestCase):
+
+    def testPrefixes(self):
+        """Prefix reads match a full read cut short, below, at and across
+        sector boundaries, for every kind of file."""
+        archive = open_archive()
+        files = archive.extract(lazy=True)
+        for (name, data, compressed, single_unit) in FIXTURE_FILES:
+            full = archive.read_file(name)
+            for n in (0, 1, 100, SECTOR_SIZE - 1, SECTOR_SIZE, SECTOR_SIZE + 1,
+                      2 * SECTOR_SIZE, 2 * SECTOR_SIZE + 10, len(data),
+                      len(data) + 100):
+                self.assertEqual(archive.read_file(name, max_bytes=n),
+                                 full[:n])
+                self.assertEqual(files.read_prefix(name, n), full[:n])
+
+    def testPrefixSkipsLaterSectors(self):
+        """Sectors after the prefix are not decompressed at all."""
+        data = build_archive()
+        archive = open_archive(data)
+        entry = archive.block_table[
+            archive.get_hash_table_entry('replay.game.events').block_table_index]
+        # break the zlib stream of the last sector.
+        end = entry.offset + entry.archived_size
+        data = data[:end - 4] + '\xff\xff\xff\xff' + data[end:]
+        archive = open_archive(data)
+        self.assertEqual(
+            archive.read_file('replay.game.events', max_bytes=SECTOR_SIZE + 1),
+            EVENTS[:SECTOR_SIZE + 1])
+        self.assertRaises(zlib.error, archive.read_file, 'replay.game.events')
+
+    def testPrefixOfMissingFile(self):
+        files = open_archive().extract(lazy=True)
+        self.assertRaises(KeyError, files.read_prefix, 'replay.sync.events', 10)
+
+
+def linear_hash_table_entry(archive, filename):
+    """The original lookup, scanning the whole hash table."""
+    hash_a = _hash(filename, 'HASH_A')
+    hash_b = _hash(filename, 'HASH_B')
+    for entry in archive.hash_table:
+        if (entry.hash_a == hash_a and entry.hash_b == hash_b):
+            return entry
+
+
+class HashIndexTest(unittest.TestCase):
+
+    def testSameEntriesAsLinearScan(self):
+        archive = open_archive()
+        for name in [f[0] for f in FIXTURE_FILES] + ['(listfile)']:
+            entry = archive.get_hash_table_entry(name)
+            self.assertTrue(entry is not None)
+            self.assertEqual(entry, linear_hash_table_entry(archive, name))
+
+    def testMissingFile(self):
+        archive = open_archive()
+        self.assertEqual(archive.get_hash_table_entry('replay.sync.events'),
+                         None)
+        self.assertEqual(linear_hash_table_entry(archive, 'replay.sync.events'),
+                         None)
+        self.assertEqual(archive.read_file('replay.sync.events'), None)
+
+    def testCollision(self):
+        """With two entries for the same name the first in the table wins,
+        as it did for the linear scan."""
+        archive = open_archive(build_archive(
+            duplicates=[('replay.details', 0), ('replay.details', 1)]))
+        matching = [e for e in archive.hash_table
+                    if (e.hash_a, e.hash_b) == (_hash('replay.details', 'HASH_A'),
+                                                _hash('replay.details', 'HASH_B'))]
+        self.assertEqual(len(matching), 3)
+        entry = archive.get_hash_table_entry('replay.details')
+        self.assertEqual(entry, matching[0])
+        self.assertEqual(entry, linear_hash_table_entry(archive, 'replay.details'))
+
+    def testHashCacheIsBounded(self):
+        saved = dict(mpyq._hash_cache)
+        mpyq._hash_cache.clear()
+        try:
+            names = ['file%04d' % i for i in range(1000)]
+            hashes = [_hash(name, 'HASH_A') for name in names]
+            self.assertEqual(len(mpyq._hash_cache), mpyq._HASH_CACHE_SIZE)
+            # cached and freshly computed hashes agree.
+            self.assertEqual([_hash(name, 'HASH_A') for name in names], hashes)
+            mpyq._hash_cache.clear()
+            self.assertEqual([_hash(name, 'HASH_A') for name in names], hashes)
+        finally:
+            mpyq._hash_cache.clear()
+            mpyq._hash_cache.update(saved)
+
+
+if __name__ == '__main__':
+    unittest.main()